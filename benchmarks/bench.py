@@ -0,0 +1,420 @@
+"""
+Offline benchmarks for the hot paths of every cog
+
+Runs each cog against a synthetic bot whose size can be scaled up, with canned
+answers instead of network requests, and writes the timings as JSON so runs on
+different commits can be compared.
+
+    python3 benchmarks/bench.py --servers 10000 --members 1000000 --output before.json
+    python3 benchmarks/bench.py --servers 10000 --members 1000000 --compare before.json
+
+Needs the same packages as the cogs themselves (discord.py, aiohttp, psutil,
+numpy and Pillow), but no Red install and no Discord connection.
+"""
+from collections import Counter
+import subprocess
+import argparse
+import datetime
+import platform
+import tempfile
+import asyncio
+import random
+import shutil
+import types
+import json
+import time
+import sys
+import os
+
+import discord
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COGS = ['statistics', 'webstatistics', 'cowsay', 'caramba', 'bible', 'btcprice']
+
+
+# Red's own cogs.utils modules, just enough for the cogs to import and store settings
+
+DATAIO = '''
+import json
+
+
+class DataIO:
+    def save_json(self, filename, data):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+    def load_json(self, filename):
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+
+    def is_valid_json(self, filename):
+        try:
+            self.load_json(filename)
+            return True
+        except (OSError, ValueError):
+            return False
+
+
+dataIO = DataIO()
+'''
+
+CHECKS = '''
+def is_owner():
+    return lambda func: func
+
+
+def admin_or_permissions(**perms):
+    return lambda func: func
+'''
+
+
+async def send_cmd_help(ctx):
+    pass
+
+
+# Canned answers for the HTTP requests the cogs make
+
+def bible_fixture(book='Psalms', verses=176):
+    chapter = {str(i): {'verse_nr': str(i), 'verse': 'Verse {} of a long chapter, '.format(i) * 4} for i in range(1, verses + 1)}
+    return '({});'.format(json.dumps({'book': [{'book_name': book, 'chapter_nr': 119, 'chapter': chapter}]}))
+
+
+TICKER_FIXTURE = {
+    currency: {'15m': 20000.0, 'last': 20000.0 + i, 'buy': 20000.0, 'sell': 20000.0, 'symbol': '$'}
+    for i, currency in enumerate(['USD', 'EUR', 'GBP', 'JPY', 'CAD', 'AUD', 'CHF', 'CNY'])}
+
+
+class FakeHTTPClient:
+    def __init__(self):
+        self.requests = Counter()
+
+    async def get(self, url, read='text', **kwargs):
+        self.requests[url] += 1
+        if 'getbible' in url:
+            return bible_fixture()
+        if url.endswith('/ticker'):
+            return TICKER_FIXTURE
+        return '12345'
+
+    async def post(self, url, **kwargs):
+        return {'access_token': 'token', 'expires_in': 3600}
+
+    def host_stats(self):
+        return {}
+
+
+# A bot with as many servers, members and channels as asked for
+
+class FakeUser:
+    __slots__ = ('id', 'name', 'discriminator', 'avatar', 'avatar_url', 'default_avatar_url', 'created_at', 'bot')
+
+    def __init__(self, id):
+        self.id = id
+        self.name = 'user{}'.format(id)
+        self.discriminator = '0001'
+        self.avatar = None
+        self.avatar_url = ''
+        self.default_avatar_url = 'https://cdn.discordapp.com/embed/avatars/0.png'
+        self.created_at = datetime.datetime(2017, 1, 1)
+        self.bot = False
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeChannel:
+    __slots__ = ('id', 'name', 'type', 'is_private', 'server')
+
+    def __init__(self, id, type, server):
+        self.id = id
+        self.name = 'channel-{}'.format(id)
+        self.type = type
+        self.is_private = False
+        self.server = server
+
+
+class FakeServer:
+    __slots__ = ('id', 'name', 'members', 'channels', 'icon_url')
+
+    def __init__(self, id):
+        self.id = id
+        self.name = 'Server {}'.format(id)
+        self.members = []
+        self.channels = []
+        self.icon_url = '' if int(id) % 3 else 'https://cdn.discordapp.com/icons/{}.png'.format(id)
+
+
+class FakeMessage:
+    __slots__ = ('author', 'server', 'channel', 'content')
+
+    def __init__(self, author, server, channel, content):
+        self.author = author
+        self.server = server
+        self.channel = channel
+        self.content = content
+
+
+class FakeBot:
+    def __init__(self, loop, servers, members, channels_per_server):
+        self.loop = loop
+        self.user = FakeUser('1')
+        self.uptime = datetime.datetime.utcnow() - datetime.timedelta(days=3)
+        self.counter = Counter(processed_commands=123456, messages_read=9876543)
+        self.settings = types.SimpleNamespace(prefixes=['!'], owner='2')
+        self.cogs = {}
+        self.commands = {}
+        self.sent = 0
+        self._ready = asyncio.Event()
+
+        # Memberships are spread over a smaller pool of users so the unique count has work to do
+        rng = random.Random(42)
+        users = [FakeUser(str(100000 + i)) for i in range(max(members * 2 // 3, 1))]
+        self.servers = [FakeServer(str(i + 1)) for i in range(servers)]
+        for i in range(members):
+            self.servers[i % servers].members.append(users[rng.randrange(len(users))])
+        channel_id = 0
+        for server in self.servers:
+            for c in range(channels_per_server):
+                channel_id += 1
+                kind = discord.ChannelType.voice if c % 4 == 3 else discord.ChannelType.text
+                server.channels.append(FakeChannel(str(channel_id), kind, server))
+        self._servers = {server.id: server for server in self.servers}
+        self._channels = {channel.id: channel for server in self.servers for channel in server.channels}
+
+    def get_all_members(self):
+        for server in self.servers:
+            yield from server.members
+
+    def get_server(self, server_id):
+        return self._servers.get(server_id)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def get_all_channels(self):
+        for server in self.servers:
+            yield from server.channels
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+
+    def add_listener(self, func, name=None):
+        pass
+
+    def dispatch(self, event, *args):
+        pass
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+    async def get_user_info(self, user_id):
+        return FakeUser(user_id)
+
+    async def say(self, *args, **kwargs):
+        self.sent += 1
+
+    async def send_message(self, *args, **kwargs):
+        self.sent += 1
+
+    async def upload(self, *args, **kwargs):
+        self.sent += 1
+
+
+def install_cogs(workdir):
+    """Lay the cogs out as Red would, as cogs.<name> next to a cogs.utils package"""
+    utils = os.path.join(workdir, 'cogs', 'utils')
+    os.makedirs(utils)
+    for path, source in [('cogs/__init__.py', ''), ('cogs/utils/__init__.py', ''),
+                         ('cogs/utils/dataIO.py', DATAIO), ('cogs/utils/checks.py', CHECKS)]:
+        with open(os.path.join(workdir, path), 'w') as f:
+            f.write(source)
+    for cog in COGS:
+        shutil.copy(os.path.join(REPO, cog, cog + '.py'), os.path.join(workdir, 'cogs', cog + '.py'))
+    sys.modules['__main__'].send_cmd_help = send_cmd_help
+    sys.path.insert(0, workdir)
+
+
+def load_cog(bot, name):
+    module = __import__('cogs.' + name, fromlist=['setup'])
+    for helper in ('check_folder', 'check_file'):
+        if hasattr(module, helper):
+            getattr(module, helper)()
+    return module
+
+
+def measure(func, repeat, number=1):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+    timings.sort()
+    return {
+        'repeat': repeat, 'number': number, 'mean_ms': sum(timings) / len(timings) * 1000,
+        'min_ms': timings[0] * 1000, 'max_ms': timings[-1] * 1000,
+        'p95_ms': timings[min(int(len(timings) * 0.95), len(timings) - 1)] * 1000}
+
+
+def run(args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    arun = loop.run_until_complete
+
+    workdir = tempfile.mkdtemp(prefix='cogbench')
+    install_cogs(workdir)
+    os.chdir(workdir)
+
+    started = time.perf_counter()
+    bot = FakeBot(loop, args.servers, args.members, args.channels)
+    build_seconds = time.perf_counter() - started
+    bot.cogs['HTTPClient'] = http = FakeHTTPClient()
+
+    def settle():
+        # Cogs start background tasks on load, none of them should run during a benchmark
+        for task in asyncio.all_tasks(loop):
+            task.cancel()
+        loop.run_until_complete(asyncio.sleep(0))
+
+    results = {}
+
+    # Statistics
+    statistics = load_cog(bot, 'statistics').Statistics(bot)
+    bot.add_cog(statistics)
+    settle()
+    for name in ('stats', 'statshistory', 'statsrefresh'):
+        bot.commands[name] = None
+    results['statistics.retrieve_statistics'] = measure(statistics.retrieve_statistics, args.repeat)
+    results['statistics.take_snapshot'] = measure(statistics._take_snapshot, args.repeat)
+    statistics.snapshot = statistics._take_snapshot()
+    results['statistics.redapi_hook'] = measure(statistics.redapi_hook, args.repeat, 100)
+    results['statistics.full_scan'] = measure(statistics._scan_counts, max(args.repeat // 5, 1))
+    results['statistics.rebuild_counters'] = measure(statistics._rebuild_counters, max(args.repeat // 5, 1))
+
+    # WebStatistics
+    webstatistics = load_cog(bot, 'webstatistics').WebStatistics(bot)
+    bot.add_cog(webstatistics)
+    settle()
+    snapshot = statistics.snapshot
+    results['webstatistics.generate_body'] = measure(lambda: arun(webstatistics.generate_body(snapshot)), args.repeat)
+    arun(webstatistics.get_page('html', 1, 'members'))
+    results['webstatistics.get_page_cached'] = measure(lambda: arun(webstatistics.get_page('html', 1, 'members')), args.repeat, 100)
+
+    # CowSay
+    cowsay = load_cog(bot, 'cowsay').CowSay(bot)
+    settle()
+    text = ' '.join('word{}'.format(i) for i in range(80))
+    results['cowsay.build_box'] = measure(lambda: cowsay.build_box(text, 40), args.repeat, 100)
+    results['cowsay.compose_memoized'] = measure(lambda: cowsay.compose(text, cowsay.get_cow(), '\\'), args.repeat, 100)
+    cowsay.renderer.shutdown()
+
+    # Caramba
+    caramba = load_cog(bot, 'caramba').Caramba(bot)
+    settle()
+    rng = random.Random(7)
+    authors = [FakeUser(str(200000 + i)) for i in range(100)]
+    servers = bot.servers[:100]
+    messages = [
+        FakeMessage(rng.choice(authors), server, server.channels[0] if server.channels else FakeChannel('0', None, server),
+                    'AYY lmao' if rng.random() < 0.1 else 'just chatting about nothing in particular')
+        for server in (rng.choice(servers) for _ in range(args.messages))]
+
+    async def feed():
+        for message in messages:
+            await caramba.listener(message)
+
+    timing = measure(lambda: arun(feed()), max(args.repeat // 5, 1))
+    timing['messages_per_second'] = args.messages / (timing['mean_ms'] / 1000)
+    results['caramba.listener'] = timing
+
+    async def feed_activity():
+        for message in messages:
+            await statistics.on_message(message)
+
+    timing = measure(lambda: arun(feed_activity()), max(args.repeat // 5, 1))
+    timing['messages_per_second'] = args.messages / (timing['mean_ms'] / 1000)
+    results['statistics.on_message'] = timing
+
+    # Bible
+    bible = load_cog(bot, 'bible').Scriptures(bot)
+    settle()
+
+    def assemble():
+        book, chapter, first, last = bible.parsePassage('psalm 119:1-176')
+        chapterData = bible.chapterVerses(json.loads(bible_fixture()[1:-2]))
+        return bible.buildEmbeds([bible.passageSection(chapterData, chapter, first, last)])
+
+    results['bible.verse_assembly'] = measure(assemble, args.repeat)
+    results['bible.cached_passage'] = measure(lambda: arun(bible.getBiblePassage('psalm 119')), args.repeat, 100)
+
+    # BTC
+    btc = load_cog(bot, 'btcprice').BTC(bot)
+    settle()
+    for i in range(args.alerts):
+        btc.alerts.add({'user': str(i % 500), 'currency': 'USD', 'direction': 'above' if i % 2 else 'below',
+                        'price': 10000.0 + rng.random() * 20000})
+    results['btcprice.cached_ticker'] = measure(lambda: arun(btc.fetch('https://blockchain.info/ticker', json=True)), args.repeat, 100)
+    results['btcprice.alert_check'] = measure(lambda: btc.alerts.triggered('USD', 20000.0 + rng.random()), args.repeat, 100)
+
+    settle()
+    loop.close()
+    os.chdir(REPO)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+        'date': datetime.datetime.utcnow().isoformat(), 'fake_http_requests': sum(http.requests.values()),
+        'scale': {'servers': args.servers, 'members': args.members, 'channels_per_server': args.channels,
+                  'messages': args.messages, 'alerts': args.alerts, 'build_seconds': build_seconds},
+        'results': results}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    print('{:<40} {:>12} {:>12} {:>8}'.format('benchmark', 'before ms', 'after ms', 'ratio'))
+    for name, timing in sorted(report['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            print('{:<40} {:>12} {:>12.4f} {:>8}'.format(name, '-', timing['mean_ms'], 'new'))
+        else:
+            ratio = timing['mean_ms'] / before['mean_ms'] if before['mean_ms'] else float('inf')
+            print('{:<40} {:>12.4f} {:>12.4f} {:>7.2f}x'.format(name, before['mean_ms'], timing['mean_ms'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--members', type=int, default=100000, help='memberships spread over all servers')
+    parser.add_argument('--channels', type=int, default=8, help='channels per server')
+    parser.add_argument('--messages', type=int, default=10000, help='messages fed to the caramba listener')
+    parser.add_argument('--alerts', type=int, default=10000, help='btc alerts registered')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='JSON report of an earlier run to compare against')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
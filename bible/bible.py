@@ -1,80 +1,423 @@
 from discord import Embed
 from discord.ext import commands 
-from requests import get 
 from json import loads 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from bisect import bisect_left
+from array import array
+from .utils import checks
+from cogs.utils.dataIO import dataIO
+import asyncio
+import aiohttp
+import heapq
+import math
+import mmap
+import time
+import os
+import re
+
+
+class BibleCorpus:
+    '''
+    A translation loaded from a local file, one verse per line as
+    book<TAB>chapter<TAB>verse<TAB>text (UTF-8, lines starting with # are skipped).
+
+    The text stays in the memory-mapped file, only offsets into it are kept
+    in arrays, so several translations don't cost much resident memory.
+    '''
+
+    wordPattern = re.compile(r"[\w']+")
+    commonRatio = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.books = []
+        self.bookNumbers = {}
+        # Verse keys are (book, chapter, verse) packed into one integer, sorted for bisecting
+        self.keys = array('I')
+        self.offsets = array('I')
+        self.lengths = array('I')
+        self.words = None
+        self.load()
+
+    @staticmethod
+    def packKey(book, chapter, verse):
+        return (book << 20) | (chapter << 10) | verse
+
+    @staticmethod
+    def normalizeBook(name):
+        return ''.join(name.lower().split())
+
+    def load(self):
+        data = self.data
+        position = 0
+        size = len(data)
+        while position < size:
+            end = data.find(b'\n', position)
+            if end == -1:
+                end = size
+            line = data[position:end]
+            if line and not line.startswith(b'#'):
+                fields = line.split(b'\t', 3)
+                if len(fields) == 4:
+                    book = self.bookNumber(fields[0].decode('utf-8').strip())
+                    text = fields[3].rstrip(b'\r')
+                    self.keys.append(self.packKey(book, int(fields[1]), int(fields[2])))
+                    self.offsets.append(position + len(line) - len(fields[3]))
+                    self.lengths.append(len(text))
+            position = end + 1
+
+        # Files are normally already in canonical order, only sort if they aren't
+        if any(self.keys[i] > self.keys[i + 1] for i in range(len(self.keys) - 1)):
+            order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+            self.keys = array('I', (self.keys[i] for i in order))
+            self.offsets = array('I', (self.offsets[i] for i in order))
+            self.lengths = array('I', (self.lengths[i] for i in order))
+
+    def bookNumber(self, name):
+        normalized = self.normalizeBook(name)
+        number = self.bookNumbers.get(normalized)
+        if number is None:
+            number = self.bookNumbers[normalized] = len(self.books)
+            self.books.append(name)
+        return number
+
+    def findBook(self, name):
+        '''Book number for a name, allowing unique prefixes like "ps" for "Psalms"'''
+        normalized = self.normalizeBook(name)
+        if normalized in self.bookNumbers:
+            return self.bookNumbers[normalized]
+        matches = [number for book, number in self.bookNumbers.items() if book.startswith(normalized) or normalized.startswith(book)]
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def text(self, row):
+        offset = self.offsets[row]
+        return self.data[offset:offset + self.lengths[row]].decode('utf-8')
+
+    def reference(self, row):
+        key = self.keys[row]
+        return self.books[key >> 20], (key >> 10) & 0x3ff, key & 0x3ff
+
+    def chapterData(self, book, chapter):
+        '''A chapter in the same shape getbible.net answers with, or None'''
+        number = self.findBook(book)
+        if number is None:
+            return None
+        start = bisect_left(self.keys, self.packKey(number, chapter, 0))
+        end = bisect_left(self.keys, self.packKey(number, chapter + 1, 0))
+        if start == end:
+            return None
+        verses = OrderedDict()
+        for row in range(start, end):
+            verse = str(self.keys[row] & 0x3ff)
+            verses[verse] = {'verse_nr': verse, 'verse': self.text(row)}
+        return {'book': [{'book_name': self.books[number], 'chapter_nr': chapter, 'chapter': verses}]}
+
+    def buildWordIndex(self):
+        postings = defaultdict(lambda: array('I'))
+        for row in range(len(self.keys)):
+            for word in set(self.wordPattern.findall(self.text(row).lower())):
+                postings[word].append(row)
+        self.words = dict(postings)
+
+    def search(self, query, limit=10):
+        '''Rows of the best matching verses, ranked by the summed rarity of the words they contain'''
+        if self.words is None:
+            self.buildWordIndex()
+        total = len(self.keys)
+        words = [word for word in set(self.wordPattern.findall(query.lower())) if self.words.get(word)]
+        if not words:
+            return []
+        # Words found in most verses barely change the ranking but have the longest postings,
+        # they only count when there is nothing rarer to go on
+        rare = [word for word in words if len(self.words[word]) <= total * self.commonRatio]
+        words = rare or [min(words, key=lambda word: len(self.words[word]))]
+        if len(words) == 1:
+            # Every row scores the same, the ranking falls back on verse order
+            return list(self.words[words[0]][:limit])
+        scores = defaultdict(float)
+        for word in words:
+            rows = self.words[word]
+            weight = math.log(1 + total / len(rows))
+            for row in rows:
+                scores[row] += weight
+        return heapq.nlargest(limit, scores, key=lambda row: (scores[row], -row))
+
+    def close(self):
+        self.data.close()
+        self.file.close()
 
 
 class Scriptures:
 
+    cacheSize = 256
+    cacheTTL = 6 * 60 * 60
+    requestTimeout = 10
+    passagePattern = re.compile(r'^\s*(.+?)\s+(\d+)(?:\s*:\s*(\d+)(?:\s*-\s*(\d+))?)?\s*$')
+
+    # Discord's embed limits
+    embedFields = 25
+    fieldLength = 1024
+    embedLength = 6000
+    maxEmbeds = 10
+
     def __init__(self, bot):
         self.bot = bot
-        self.bible = 'https://getbible.net/json?scrip={}'
+        self.bible = 'https://getbible.net/json'
         self.biblePicture = 'http://pacificbible.com/wp/wp-content/uploads/2015/03/holy-bible.png'
+        self.passageCache = OrderedDict()
+        self.inFlight = {}
+        self.settings = dataIO.load_json('data/bible/settings.json')
+        self.corpus = None
+        self.corpusLoader = None
+        if self.settings.get('translation'):
+            self.corpusLoader = self.bot.loop.create_task(self.loadSavedCorpus(self.settings['translation']))
+
+    def __unload(self):
+        if self.corpusLoader is not None:
+            self.corpusLoader.cancel()
+        if self.corpus is not None:
+            self.corpus.close()
+
+    async def loadSavedCorpus(self, name):
+        '''Loads the translation from the settings, getbible.net is used on its own if that fails'''
+        try:
+            await self.loadCorpus(name)
+        except (OSError, ValueError) as e:
+            print('bible.py: Couldn\'t load the {} translation, using getbible.net only: {}'.format(name, e))
 
-    def getBiblePassage(self, passage):
+    async def loadCorpus(self, name):
+        '''Loads data/bible/<name>.tsv off the event loop and makes it the local translation'''
+        path = os.path.join('data/bible', '{}.tsv'.format(name))
+        corpus = await self.bot.loop.run_in_executor(None, BibleCorpus, path)
+        if self.corpus is not None:
+            self.corpus.close()
+        self.corpus = corpus
+        return corpus
+
+    async def getBiblePassage(self, passage):
         '''Goes through the getbible api to get a list of applicable bible passages'''
-        toRetrieveFrom = self.bible.format(passage)
-        data = get(toRetrieveFrom).text[1:-2]
-        return loads(data)
+        key = ' '.join(passage.lower().split())
+
+        # Serve from the cache while it's fresh, most recently used entries go to the end
+        cached = self.passageCache.get(key)
+        if cached is not None:
+            expires, data = cached
+            if expires > time.monotonic():
+                self.passageCache.move_to_end(key)
+                return data
+            del self.passageCache[key]
+
+        # Everyone asking for the same passage at once waits on the same request
+        future = self.inFlight.get(key)
+        if future is None:
+            future = self.inFlight[key] = asyncio.ensure_future(self.fetchBiblePassage(key))
+            future.add_done_callback(lambda _: self.inFlight.pop(key, None))
+        data = await asyncio.shield(future)
+
+        self.passageCache[key] = (time.monotonic() + self.cacheTTL, data)
+        self.passageCache.move_to_end(key)
+        while len(self.passageCache) > self.cacheSize:
+            self.passageCache.popitem(last=False)
+        return data
+
+    def httpClient(self):
+        '''The shared HTTPClient cog, a missing one fails like any other request would'''
+        client = self.bot.get_cog('HTTPClient')
+        if client is None:
+            raise aiohttp.ClientError('HTTPClient isn\'t loaded')
+        return client
+
+    async def fetchBiblePassage(self, passage):
+        '''Does the actual request to getbible, which answers in JSONP'''
+        text = await self.httpClient().get(self.bible, params={'scrip': passage}, timeout=self.requestTimeout)
+        return loads(text[1:-2])
+
+    def parsePassage(self, passage):
+        '''
+        Splits up a passage like "1 john 3:16-18" or "psalm 23".
+
+        Returns (book, chapter, first verse, last verse), the verses are None for a whole chapter.
+        '''
+        match = self.passagePattern.match(passage)
+        if match is None:
+            return None
+        book, chapter, first, last = match.groups()
+        if first is None:
+            return book, int(chapter), None, None
+        first, last = int(first), int(last or first)
+        return book, int(chapter), min(first, last), max(first, last)
+
+    def chapterVerses(self, bibleData):
+        '''Book name and a verse number to text dict, from either answer shape getbible.net uses'''
+        if 'book' in bibleData:
+            bibleData = bibleData['book'][0]
+        verses = {str(i['verse_nr']): i['verse'] for i in bibleData['chapter'].values()}
+        return bibleData['book_name'], verses
+
+    async def getChapter(self, book, chapter):
+        bibleData = None
+        if self.corpus is not None:
+            bibleData = self.corpus.chapterData(book, chapter)
+        if bibleData is None:
+            bibleData = await self.getBiblePassage('{} {}'.format(book, chapter))
+        return self.chapterVerses(bibleData)
+
+    def passageSection(self, chapterData, chapter, first, last):
+        '''The (title, [(verse number, text)]) section buildEmbeds shows for one passage of a chapter'''
+        bookName, verses = chapterData
+        if first is None:
+            numbers = sorted(verses, key=int)
+            title = '{} {}'.format(bookName, chapter)
+        else:
+            numbers = [str(i) for i in range(first, last + 1) if str(i) in verses]
+            title = '{} {}:{}'.format(bookName, chapter, first if first == last else '{}-{}'.format(first, last))
+        return title, [(number, verses[number]) for number in numbers]
+
+    def buildEmbeds(self, sections):
+        '''Spreads (title, [(name, text)]) sections over as many embeds as Discord's limits need'''
+        embeds = []
+        for title, fields in sections:
+            em = None
+            for name, text in fields:
+                # Verses longer than a field can hold are continued in the next field
+                chunks = [text[i:i + self.fieldLength] for i in range(0, len(text), self.fieldLength)] or ['\u200b']
+                for chunk in chunks:
+                    if em is None or len(em.fields) >= self.embedFields or size + len(name) + len(chunk) > self.embedLength:
+                        author = title if em is None else '{} (continued)'.format(title)
+                        em = Embed()
+                        em.set_author(name=author, icon_url=self.biblePicture)
+                        embeds.append(em)
+                        size = len(title) + 12
+                    em.add_field(name=name, value=chunk, inline=False)
+                    size += len(name) + len(chunk)
+        return embeds
 
     @commands.command(aliases=['christianity', 'bible'])
     async def christian(self, *, passage:str):
         '''
-        Gets a passage from the bible.
-        '''
+        Gets passages from the bible.
 
-        # Get the passasges into a nice variable setup
-        chapter = []
-        sPassage = passage.split(' ')
-        while True:
-            if ':' in sPassage[0]:
-                break 
-            else:
-                chapter.append(sPassage[0])
-                del sPassage[0]
-
-        chapter = ' '.join(chapter)
-        passagesVerses = sPassage[0].split(':')
-        verse = passagesVerses[0]
-        passages = passagesVerses[1].replace(' ','').split('-')
-        if len(passages) == 1: passages = passages + passages
+        Separate several passages with a semicolon:
+        [p]bible john 3:16; luke 14:34-35; psalm 23
+        '''
 
         # So from here, luke 14:34-35 is split up as so:
-        #     chapter = 'luke'
-        #     passages = ['34', '35']
-
-        # Actually go get all the data from the site
-        bibleData = self.getBiblePassage(passage)
-
-        # Get the nice passages and stuff
-        bookName = bibleData['book'][0]['book_name']
-        verses = bibleData['book'][0]['chapter']
-        listedVerses = [(i['verse_nr'], i['verse']) for i in verses.values()]
-        '''[('34', 'Salt is good'), ('35', 'Beef is bad')]'''
-
-        # Order the list properly
-        passageInt = sorted([int(i) for i in passages])
-        sortedVerses = []
-        i = passageInt[0]
-        while i < passageInt[1] + 1:
-            q = [w for w in listedVerses if w[0] == str(i)]
-            sortedVerses.append(q[0])
-            i += 1
-
-        # Embed it
-        embeddableDict = OrderedDict()
-        for i in sortedVerses:
-            embeddableDict[i[0]] = i[1]
+        #     ('luke', 14, 34, 35)
+        # and psalm 23 as ('psalm', 23, None, None)
+        passages = []
+        for part in passage.split(';'):
+            if not part.strip():
+                continue
+            parsed = self.parsePassage(part)
+            if parsed is None:
+                await self.bot.say('I don\'t understand "{}", try something like john 3:16.'.format(part.strip()[:100]))
+                return
+            passages.append(parsed)
+        if not passages:
+            return
 
-        em = Embed()
-        em.set_author(name=bookName, icon_url=self.biblePicture)
-        for i, o in embeddableDict.items():
-            em.add_field(name=i, value=o, inline=False)
+        # Actually go get all the chapters at once, each distinct chapter only once
+        chapters = list(OrderedDict.fromkeys((book.lower(), chapter) for book, chapter, _, _ in passages))
+        results = await asyncio.gather(*[self.getChapter(book, chapter) for book, chapter in chapters], return_exceptions=True)
+        results = dict(zip(chapters, results))
+
+        # Put the verses of every passage in order
+        sections = []
+        for book, chapter, first, last in passages:
+            result = results[(book.lower(), chapter)]
+            if isinstance(result, aiohttp.ClientError) and self.bot.get_cog('HTTPClient') is None:
+                await self.bot.say('Couldn\'t get {} {}, the HTTPClient cog isn\'t loaded.'.format(book, chapter))
+                continue
+            elif isinstance(result, (asyncio.TimeoutError, aiohttp.ClientError, ValueError, KeyError, IndexError)):
+                await self.bot.say('Couldn\'t get {} {} from getbible.net, try again later.'.format(book, chapter))
+                continue
+            elif isinstance(result, Exception):
+                raise result
+            title, fields = self.passageSection(result, chapter, first, last)
+            if not fields:
+                await self.bot.say('{} doesn\'t have those verses.'.format(title))
+                continue
+            sections.append((title, fields))
 
         # Boop it to the user
+        embeds = self.buildEmbeds(sections)
+        for em in embeds[:self.maxEmbeds]:
+            await self.bot.say(embed=em)
+        if len(embeds) > self.maxEmbeds:
+            await self.bot.say('That\'s a lot of scripture, I stopped after {} messages.'.format(self.maxEmbeds))
+
+    @commands.command()
+    async def biblesearch(self, *, words:str):
+        '''
+        Searches the local translation for verses containing these words.
+        '''
+        if self.corpus is None:
+            await self.bot.say('There is no local translation loaded, the owner can set one with biblelocal.')
+            return
+
+        corpus = self.corpus
+        if corpus.words is None:
+            # Building the word index takes a moment the first time, keep it off the event loop
+            await self.bot.loop.run_in_executor(None, corpus.buildWordIndex)
+        # Scoring walks every posting of the query's words, that stays off the event loop as well
+        rows = await self.bot.loop.run_in_executor(None, corpus.search, words)
+        if not rows:
+            await self.bot.say('No verses found.')
+            return
+
+        em = Embed()
+        em.set_author(name='Verses matching "{}"'.format(words[:200]), icon_url=self.biblePicture)
+        for row in rows:
+            em.add_field(name='{} {}:{}'.format(*corpus.reference(row)), value=corpus.text(row)[:1024], inline=False)
         await self.bot.say(embed=em)
 
+    @commands.command()
+    @checks.is_owner()
+    async def biblelocal(self, name:str=None):
+        '''
+        Sets the local translation, loaded from data/bible/<name>.tsv.
+
+        Leave the name out to go back to getbible.net only.
+        '''
+        if self.corpusLoader is not None:
+            # The translation from the settings mustn't land on top of this choice later
+            self.corpusLoader.cancel()
+        if name is None:
+            if self.corpus is not None:
+                self.corpus.close()
+            self.corpus = None
+            message = 'Stopped using a local translation.'
+        else:
+            try:
+                corpus = await self.loadCorpus(name)
+            except (OSError, ValueError) as e:
+                await self.bot.say('Couldn\'t load that translation: {}'.format(e))
+                return
+            message = 'Loaded {} verses from {}.'.format(len(corpus.keys), name)
+        self.settings['translation'] = name
+        dataIO.save_json('data/bible/settings.json', self.settings)
+        await self.bot.say(message)
+
+
+def check_folder():
+    if not os.path.exists('data/bible'):
+        print('Creating data/bible folder...')
+        os.makedirs('data/bible')
+
+
+def check_file():
+    data = {}
+    data['translation'] = None
+    if not dataIO.is_valid_json('data/bible/settings.json'):
+        print('Creating settings.json...')
+        dataIO.save_json('data/bible/settings.json', data)
+
 
 def setup(bot):
+    check_folder()
+    check_file()
     bot.add_cog(Scriptures(bot))
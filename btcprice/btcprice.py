@@ -1,19 +1,269 @@
 import discord
 from discord.ext import commands
+from __main__ import send_cmd_help
+from cogs.utils.dataIO import dataIO
+from .utils import checks
+import asyncio
 import aiohttp
+import heapq
+import time
+import io
+import os
+import re
+
+try:
+    import numpy
+except:
+    numpy = False
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except:
+    Image = False
+
+
+class PriceSeries:
+    """Fixed-size ring of (time, price) samples for one currency."""
+
+    def __init__(self, capacity=10080):
+        self.times = numpy.zeros(capacity, dtype=numpy.float64)
+        self.prices = numpy.zeros(capacity, dtype=numpy.float64)
+        self.capacity = capacity
+        self.index = 0
+        self.count = 0
+
+    def append(self, timestamp, price):
+        self.times[self.index] = timestamp
+        self.prices[self.index] = price
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def window(self, seconds, now=None):
+        """Prices from the last few seconds, oldest first."""
+        now = time.time() if now is None else now
+        if self.count < self.capacity:
+            times, prices = self.times[:self.count], self.prices[:self.count]
+        else:
+            times = numpy.roll(self.times, -self.index)
+            prices = numpy.roll(self.prices, -self.index)
+        return prices[times >= now - seconds]
+
+    @staticmethod
+    def summary(prices):
+        returns = numpy.diff(numpy.log(prices)) if len(prices) > 1 else numpy.zeros(1)
+        return {
+            'min': float(prices.min()), 'max': float(prices.max()), 'mean': float(prices.mean()),
+            'volatility': float(returns.std() * 100), 'change': float((prices[-1] / prices[0] - 1) * 100)}
+
+
+def render_sparkline(prices, width=400, height=100):
+    """Draws prices as a PNG sparkline, returns it in a buffer ready to upload."""
+    image = Image.new('RGB', (width, height), (47, 49, 54))
+    draw = ImageDraw.Draw(image)
+    low, high = float(prices.min()), float(prices.max())
+    span = (high - low) or 1
+    xs = numpy.linspace(4, width - 4, len(prices))
+    ys = height - 14 - (prices - low) / span * (height - 28)
+    draw.line(list(zip(xs.tolist(), ys.tolist())), fill=(247, 147, 26), width=2)
+    font = ImageFont.load_default()
+    draw.text((4, 0), '{:.2f}'.format(high), fill=(220, 221, 222), font=font)
+    draw.text((4, height - 12), '{:.2f}'.format(low), fill=(220, 221, 222), font=font)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+
+class AlertBook:
+    """
+    Price alerts kept in per-currency heaps: a min-heap of thresholds to rise above
+    and a max-heap of thresholds to fall below. Checking a price only pops the
+    alerts that fired, O(log n) each, removed alerts are skipped lazily.
+    """
+
+    def __init__(self, alerts=()):
+        self.alerts = {}
+        self.above = {}
+        self.below = {}
+        self.next_id = 1
+        self.removed = 0
+        for alert in alerts:
+            self.add(alert)
+
+    def add(self, alert):
+        if 'id' not in alert:
+            alert['id'] = self.next_id
+        self.next_id = max(self.next_id, alert['id'] + 1)
+        self.alerts[alert['id']] = alert
+        if alert['direction'] == 'above':
+            heapq.heappush(self.above.setdefault(alert['currency'], []), (alert['price'], alert['id']))
+        else:
+            heapq.heappush(self.below.setdefault(alert['currency'], []), (-alert['price'], alert['id']))
+        return alert
+
+    def remove(self, alert_id):
+        alert = self.alerts.pop(alert_id, None)
+        if alert is not None:
+            self.removed += 1
+            # Rebuild once dead entries outnumber live ones so the heaps stay small
+            if self.removed > len(self.alerts):
+                next_id = self.next_id
+                self.__init__(list(self.alerts.values()))
+                self.next_id = next_id
+        return alert
+
+    def for_user(self, user_id):
+        return [alert for alert in self.alerts.values() if alert['user'] == user_id]
+
+    def triggered(self, currency, price):
+        """Removes and returns every alert for currency that price sets off."""
+        fired = []
+        above = self.above.get(currency)
+        while above and above[0][0] <= price:
+            fired.append(heapq.heappop(above)[1])
+        below = self.below.get(currency)
+        while below and -below[0][0] >= price:
+            fired.append(heapq.heappop(below)[1])
+        alerts = []
+        for alert_id in fired:
+            alert = self.alerts.pop(alert_id, None)
+            if alert is None:
+                self.removed -= 1
+            else:
+                alerts.append(alert)
+        return alerts
+
 
 class BTC:
+    ALERT_POLL_INTERVAL = 60
 
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession(loop=bot.loop)
+        self.settings = dataIO.load_json('data/btcprice/settings.json')
+        self.cache = {}
+        self.in_flight = {}
+        self.history = {}
+        self.alerts = AlertBook(dataIO.load_json('data/btcprice/alerts.json'))
+        self.alerts_dirty = False
+        self.alert_writer = self.bot.loop.create_task(self.write_alerts())
+        self.poller = None
+        self.start_poller()
+
+    def __unload(self):
+        if self.poller is not None:
+            self.poller.cancel()
+        self.alert_writer.cancel()
+        if self.alerts_dirty:
+            dataIO.save_json('data/btcprice/alerts.json', list(self.alerts.alerts.values()))
+
+    async def write_alerts(self):
+        """Saves alert changes in batches off the event loop instead of on every change."""
+        while True:
+            await asyncio.sleep(30)
+            if self.alerts_dirty:
+                self.alerts_dirty = False
+                alerts = [dict(alert) for alert in self.alerts.alerts.values()]
+                await self.bot.loop.run_in_executor(None, dataIO.save_json, 'data/btcprice/alerts.json', alerts)
+
+    async def fetch(self, url, json=False):
+        """Gets url through the cache, stale answers are served while a fresh one is fetched."""
+        entry = self.cache.get(url)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.settings['cache_ttl']:
+                return entry[1]
+            if age < self.settings['cache_ttl'] + self.settings['stale_ttl']:
+                self.refresh(url, json)
+                return entry[1]
+        return await asyncio.shield(self.refresh(url, json))
+
+    def refresh(self, url, json=False):
+        """Starts fetching url unless that is already happening, everyone shares the same request."""
+        future = self.in_flight.get(url)
+        if future is None:
+            future = self.in_flight[url] = asyncio.ensure_future(self._fetch(url, json))
+            future.add_done_callback(lambda f: self._refresh_done(url, f))
+        return future
+
+    def _refresh_done(self, url, future):
+        self.in_flight.pop(url, None)
+        # Background refreshes have nobody waiting on them, don't leave their errors unretrieved
+        if not future.cancelled():
+            future.exception()
+
+    def http_client(self):
+        """The shared HTTPClient cog, a missing one fails like any other request would."""
+        client = self.bot.get_cog('HTTPClient')
+        if client is None:
+            raise aiohttp.ClientError("HTTPClient isn't loaded")
+        return client
+
+    async def _fetch(self, url, json):
+        value = await self.http_client().get(url, read='json' if json else 'text')
+        self.cache[url] = (time.monotonic(), value)
+        if url == 'https://blockchain.info/ticker':
+            self.record_ticker(value)
+        return value
+
+    def record_ticker(self, ticker):
+        now = time.time()
+        for currency, data in ticker.items():
+            series = self.history.get(currency)
+            if series is None:
+                series = self.history[currency] = PriceSeries()
+            series.append(now, data['last'])
+        self.bot.loop.create_task(self.check_alerts(ticker))
+
+    async def check_alerts(self, ticker):
+        fired = []
+        for currency, data in ticker.items():
+            fired.extend((alert, data) for alert in self.alerts.triggered(currency, data['last']))
+        if not fired:
+            return
+        self.alerts_dirty = True
+        for alert, data in fired:
+            try:
+                user = await self.bot.get_user_info(alert['user'])
+                await self.bot.send_message(user, 'BTC is now {}{} {}, {} your alert at {}{}.'.format(
+                    data['symbol'], data['last'], alert['currency'], alert['direction'], data['symbol'], alert['price']))
+            except discord.HTTPException:
+                pass
+
+    def poll_interval(self):
+        """Seconds between ticker polls, alerts need polling even when the owner turned it off."""
+        if self.settings['poll_interval']:
+            return self.settings['poll_interval']
+        return self.ALERT_POLL_INTERVAL if self.alerts.alerts else 0
+
+    def start_poller(self):
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+        if self.poll_interval():
+            self.poller = self.bot.loop.create_task(self.poll_ticker())
+
+    async def poll_ticker(self):
+        """Keeps the ticker warm so price commands answer from memory, and checks alerts."""
+        while self.poll_interval():
+            try:
+                # Shielded like fetch(), cancelling the poller must not cancel a request others share
+                await asyncio.shield(self.refresh('https://blockchain.info/ticker', json=True))
+            except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+                print('btcprice.py: Failed to poll the ticker: {}'.format(e))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # One odd tick must not stop alerts from being checked for good
+                print('btcprice.py: Unexpected error while polling the ticker: {!r}'.format(e))
+            await asyncio.sleep(self.poll_interval() or 0)
+        # Nothing left to poll for, btcalert add starts it again
+        self.poller = None
 
     @commands.command(pass_context=True)
     async def currency(self, ctx, currency:str):
         """fetches the price of btc in a currency."""
         url = 'https://blockchain.info/ticker'
-        async with self.session.get(url) as resp:
-            temp = await resp.json()
+        temp = await self.fetch(url, json=True)
         btc = temp[currency]
         await self.bot.say(btc['symbol'] + '' + str(btc['last']))
 
@@ -21,35 +271,145 @@ class BTC:
     async def unconf(self, ctx):
         """Shows the amount of unconfirmed transactions."""
         url = 'https://blockchain.info/q/unconfirmedcount'
-        async with self.session.get(url) as resp:
-            text = await resp.text()
+        text = await self.fetch(url)
         await self.bot.say(text)
         
     @commands.command(pass_context=True)
     async def totalbtc(self, ctx):
         """Shows the total amount of Bitcoin."""
         url = 'https://blockchain.info/q/totalbc'
-        async with self.session.get(url) as resp:
-            text = await resp.text()
+        text = await self.fetch(url)
         await self.bot.say(text)
 
     @commands.command(pass_context=True)
     async def hrprice(self, ctx):
         """Shows the 24 hour price."""
         url = 'https://blockchain.info/q/24hrprice'
-        async with self.session.get(url) as resp:
-            text = await resp.text()
+        text = await self.fetch(url)
         await self.bot.say(text)
         
     @commands.command(pass_context=True)
     async def hrcount(self, ctx):
         """Shows the 24hr transactioncount."""
         url = 'https://blockchain.info/q/24hrtransactioncount'
-        async with self.session.get(url) as resp:
-            text = await resp.text()
+        text = await self.fetch(url)
         await self.bot.say(text)
 
+    @commands.command(pass_context=True)
+    async def btchistory(self, ctx, currency:str, window:str='1h'):
+        """Shows the price range of btc in a currency over a window like 30m, 6h or 2d."""
+        match = re.fullmatch(r'(\d+)([smhd]?)', window.lower())
+        if not match:
+            await self.bot.say('Windows look like 30m, 6h or 2d.')
+            return
+        seconds = int(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+        currency = currency.upper()
+        series = self.history.get(currency)
+        prices = series.window(seconds) if series is not None else []
+        if len(prices) < 2:
+            await self.bot.say('Not enough {} prices seen in that window yet, turn on `{}btcpoll` to collect them.'.format(currency, ctx.prefix))
+            return
+        stats = PriceSeries.summary(prices)
+        text = ('{currency} over {window}: min {min:.2f}, max {max:.2f}, mean {mean:.2f}, '
+                'change {change:+.2f}%, volatility {volatility:.3f}% per sample').format(currency=currency, window=window, **stats)
+        # Drawing is CPU work, keep it off the event loop
+        image = await self.bot.loop.run_in_executor(None, render_sparkline, prices)
+        await self.bot.upload(image, filename='btc_{}.png'.format(currency), content=text)
+
+    @commands.group(pass_context=True)
+    async def btcalert(self, ctx):
+        """Get a message when btc goes above or below a price."""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @btcalert.command(pass_context=True, name='add')
+    async def btcalert_add(self, ctx, currency:str, direction:str, price:float):
+        """Example: [p]btcalert add USD above 20000"""
+        direction = {'>': 'above', '<': 'below'}.get(direction, direction.lower())
+        currency = currency.upper()
+        if direction not in ('above', 'below'):
+            await self.bot.say('The direction has to be above or below.')
+            return
+        if len(self.alerts.for_user(ctx.message.author.id)) >= 10:
+            await self.bot.say('You already have 10 alerts, remove one first.')
+            return
+        alert = self.alerts.add({'user': ctx.message.author.id, 'currency': currency, 'direction': direction, 'price': price})
+        self.alerts_dirty = True
+        if self.poller is None or self.poller.done():
+            self.start_poller()
+        await self.bot.say('Alert {} set: {} {} {}.'.format(alert['id'], currency, direction, price))
+
+    @btcalert.command(pass_context=True, name='list')
+    async def btcalert_list(self, ctx):
+        """Shows your alerts."""
+        alerts = self.alerts.for_user(ctx.message.author.id)
+        if not alerts:
+            await self.bot.say('You have no alerts.')
+            return
+        await self.bot.say('\n'.join('`{id}` {currency} {direction} {price}'.format(**alert) for alert in alerts))
+
+    @btcalert.command(pass_context=True, name='remove')
+    async def btcalert_remove(self, ctx, alert_id:int):
+        """Removes one of your alerts."""
+        alert = self.alerts.alerts.get(alert_id)
+        if alert is None or alert['user'] != ctx.message.author.id:
+            await self.bot.say('You have no alert with that id.')
+            return
+        self.alerts.remove(alert_id)
+        self.alerts_dirty = True
+        await self.bot.say('Alert {} removed.'.format(alert_id))
+
+    @commands.command()
+    @checks.is_owner()
+    async def btccache(self, ttl:int, stale:int=None):
+        """Sets how many seconds answers are cached, and how long stale ones may be served while refreshing."""
+        self.settings['cache_ttl'] = max(ttl, 0)
+        if stale is not None:
+            self.settings['stale_ttl'] = max(stale, 0)
+        dataIO.save_json('data/btcprice/settings.json', self.settings)
+        await self.bot.say('Caching answers for {} seconds, serving stale ones for {} more.'.format(
+            self.settings['cache_ttl'], self.settings['stale_ttl']))
+
+    @commands.command()
+    @checks.is_owner()
+    async def btcpoll(self, seconds:int=0):
+        """Polls the ticker in the background every few seconds, 0 turns it off."""
+        self.settings['poll_interval'] = max(seconds, 0)
+        dataIO.save_json('data/btcprice/settings.json', self.settings)
+        self.start_poller()
+        if seconds > 0:
+            await self.bot.say('Polling the ticker every {} seconds.'.format(seconds))
+        elif self.poller is not None:
+            await self.bot.say('Polling the ticker every {} seconds while there are alerts.'.format(self.ALERT_POLL_INTERVAL))
+        else:
+            await self.bot.say('Stopped polling the ticker.')
+
+
+def check_folder():
+    if not os.path.exists('data/btcprice'):
+        print('Creating data/btcprice folder...')
+        os.makedirs('data/btcprice')
+
+
+def check_file():
+    data = {}
+    data['cache_ttl'] = 15
+    data['stale_ttl'] = 60
+    data['poll_interval'] = 0
+    if not dataIO.is_valid_json('data/btcprice/settings.json'):
+        print('Creating settings.json...')
+        dataIO.save_json('data/btcprice/settings.json', data)
+    if not dataIO.is_valid_json('data/btcprice/alerts.json'):
+        print('Creating alerts.json...')
+        dataIO.save_json('data/btcprice/alerts.json', [])
+
         
 def setup(bot):
+    if numpy is False:
+        raise RuntimeError('numpy is not installed. Run `pip3 install numpy --upgrade` to use this cog.')
+    elif Image is False:
+        raise RuntimeError('Pillow is not installed. Run `pip3 install Pillow --upgrade` to use this cog.')
+    check_folder()
+    check_file()
     n = BTC(bot)
     bot.add_cog(n)
@@ -1,14 +1,132 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from discord.ext import commands
+from __main__ import send_cmd_help
+from cogs.utils.dataIO import dataIO
+from .utils import checks
+
+
 class Caramba:
+    DEFAULT_TRIGGERS = {'ayy': '¡Caramba!', 'aayy': '¡Caramba!'}
+    MAX_COOLDOWNS = 10000
+
     def __init__(self, bot):
         self.bot = bot
+        self.settings = dataIO.load_json('data/caramba/settings.json')
+        self.matchers = {}
+        self.cooldowns = OrderedDict()
+
+    def _triggers(self, server_id):
+        return self.settings['servers'].get(server_id, {}).get('triggers', self.DEFAULT_TRIGGERS)
+
+    def _matcher(self, server_id):
+        # All of a server's triggers are compiled into one pattern, longest first so the best match wins
+        matcher = self.matchers.get(server_id)
+        if matcher is None:
+            # An empty trigger would match every message, so one saved before triggers were checked is ignored
+            responses = {trigger.lower(): response for trigger, response in self._triggers(server_id).items() if trigger.strip()}
+            if responses:
+                alternation = '|'.join(re.escape(trigger) for trigger in sorted(responses, key=len, reverse=True))
+                pattern = re.compile(alternation)
+            else:
+                pattern = None
+            matcher = self.matchers[server_id] = (pattern, responses)
+        return matcher
+
+    def _cooling_down(self, channel_id):
+        # Remembers only the most recently active channels, so a spam wave can't grow it without bound
+        now = time.monotonic()
+        last = self.cooldowns.get(channel_id)
+        if last is not None and now - last < self.settings['cooldown']:
+            return True
+        self.cooldowns[channel_id] = now
+        self.cooldowns.move_to_end(channel_id)
+        if len(self.cooldowns) > self.MAX_COOLDOWNS:
+            self.cooldowns.popitem(last=False)
+        return False
 
     async def listener(self, message):
         if message.author.id != self.bot.user.id:
-            if message.content.lower().startswith('ayy') or message.content.lower().startswith('aayy'):
-                await self.bot.send_message(message.channel, '¡Caramba!')
+            pattern, responses = self._matcher(message.server.id if message.server else None)
+            if pattern is None:
+                return
+            match = pattern.match(message.content.lower())
+            if match and not self._cooling_down(message.channel.id):
+                await self.bot.send_message(message.channel, responses[match.group(0)])
+
+    def _save_triggers(self, server, triggers):
+        self.settings['servers'][server.id] = {'triggers': triggers}
+        self.matchers.pop(server.id, None)
+        dataIO.save_json('data/caramba/settings.json', self.settings)
+
+    @commands.group(pass_context=True, no_pm=True)
+    @checks.admin_or_permissions(manage_server=True)
+    async def caramba(self, ctx):
+        """Manage the messages that get an answer"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @caramba.command(pass_context=True, name='add')
+    async def caramba_add(self, ctx, trigger: str, *, response: str):
+        """Answer messages starting with trigger"""
+        trigger = trigger.strip()
+        if not trigger:
+            await self.bot.say('`The trigger can\'t be empty`')
+            return
+        triggers = dict(self._triggers(ctx.message.server.id))
+        triggers[trigger.lower()] = response
+        self._save_triggers(ctx.message.server, triggers)
+        await self.bot.say('`Answering messages starting with {}`'.format(trigger))
+
+    @caramba.command(pass_context=True, name='remove')
+    async def caramba_remove(self, ctx, trigger: str):
+        """Stop answering a trigger"""
+        triggers = dict(self._triggers(ctx.message.server.id))
+        if triggers.pop(trigger.lower(), None) is None:
+            await self.bot.say('`There is no such trigger`')
+            return
+        self._save_triggers(ctx.message.server, triggers)
+        await self.bot.say('`Removed {}`'.format(trigger))
+
+    @caramba.command(pass_context=True, name='list')
+    async def caramba_list(self, ctx):
+        """List the triggers of this server"""
+        triggers = self._triggers(ctx.message.server.id)
+        if not triggers:
+            await self.bot.say('`There are no triggers`')
+            return
+        lines = ['{} -> {}'.format(trigger, response) for trigger, response in sorted(triggers.items())]
+        await self.bot.say('```\n{}\n```'.format('\n'.join(lines))[:2000])
+
+    @caramba.command(name='cooldown')
+    @checks.is_owner()
+    async def caramba_cooldown(self, seconds: int):
+        """Set how many seconds a channel waits between answers"""
+        self.settings['cooldown'] = max(seconds, 0)
+        dataIO.save_json('data/caramba/settings.json', self.settings)
+        await self.bot.say('`Channels now wait {} seconds between answers`'.format(self.settings['cooldown']))
+
+
+def check_folder():
+    if not os.path.exists('data/caramba'):
+        print('Creating data/caramba folder...')
+        os.makedirs('data/caramba')
+
+
+def check_file():
+    data = {}
+    data['cooldown'] = 5
+    data['servers'] = {}
+    if not dataIO.is_valid_json('data/caramba/settings.json'):
+        print('Creating settings.json...')
+        dataIO.save_json('data/caramba/settings.json', data)
 
 
 def setup(bot):
+    check_folder()
+    check_file()
     n = Caramba(bot)
     bot.add_listener(n.listener, "on_message")
     bot.add_cog(n)
@@ -4,9 +4,92 @@ import textwrap
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
-import asyncio, aiohttp, io, time, imghdr, os, json
+import asyncio, aiohttp, io, time, imghdr, os, json, re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from __main__ import send_cmd_help
 
+COW_DIRECTORY = "data/cowsay/cows"
+
+# An escaped character, or one of the slots a cowfile fills in
+COW_TOKEN = re.compile(r"\\(.)|\$\{?(thoughts|eyes|tongue)\}?", re.S)
+COW_HEREDOC = re.compile(r"\$the_cow\s*=\s*<<\s*\"?(\w+)\"?\s*;?[^\n]*\n(.*?)^\1\s*$", re.S | re.M)
+
+def compile_cow(body, escapes=True):
+    """ Split a cow into literal text and slot names, alternating. """
+    parts = []
+    literal = []
+    position = 0
+    for match in COW_TOKEN.finditer(body):
+        literal.append(body[position:match.start()])
+        if match.group(1) is not None:
+            literal.append(match.group(1) if escapes else match.group(0))
+        else:
+            parts.append("".join(literal))
+            parts.append(match.group(2))
+            literal = []
+        position = match.end()
+    literal.append(body[position:])
+    parts.append("".join(literal))
+    return tuple(parts)
+
+def fill_cow(parts, thoughts, eyes="oo", tongue="  "):
+    slots = {"thoughts": thoughts, "eyes": eyes, "tongue": tongue}
+    return "".join(slots[part] if index % 2 else part for index, part in enumerate(parts))
+
+@lru_cache(maxsize=32)
+def load_cowfile(path, mtime):
+    """ Parse a .cow file into a template, cached until the file changes. """
+    with open(path, encoding="utf-8", errors="replace") as f:
+        match = COW_HEREDOC.search(f.read())
+    if match is None:
+        raise ValueError("{} has no $the_cow heredoc".format(path))
+    return compile_cow("\n" + match.group(2))
+
+DEFAULT_COW = compile_cow(r"""
+         $thoughts   ^__^
+          $thoughts  ($eyes)\_______
+             (__)\       )\/\
+                 ||----w |
+                 ||     ||
+        """, escapes=False)
+
+# Fonts are loaded once per worker process and reused for every render
+_fonts = {}
+
+def _get_font(size):
+    font = _fonts.get(size)
+    if font is None:
+        try:
+            font = ImageFont.truetype('DejaVuSansMono.ttf', size)
+        except OSError:
+            font = ImageFont.load_default()
+        _fonts[size] = font
+    return font
+
+def _text_size(font, text):
+    if hasattr(font, 'getbbox'):
+        left, top, right, bottom = font.getbbox(text)
+        return right, bottom
+    return font.getsize(text)
+
+def render_cow(text, size=16, padding=12):
+    """ Render cowsay text to PNG bytes, runs in a worker process. """
+    font = _get_font(size)
+    lines = text.split("\n")
+    char_width, _ = _text_size(font, "M")
+    _, line_height = _text_size(font, "Mg|")
+    line_height += 2
+    width = char_width * max(len(line) for line in lines) + padding * 2
+    height = line_height * len(lines) + padding * 2
+    image = Image.new("RGB", (width, height), (54, 57, 63))
+    draw = ImageDraw.Draw(image)
+    for index, line in enumerate(lines):
+        draw.text((padding, padding + index * line_height), line, font=font, fill=(220, 221, 222))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
 class CowSay:
     """
     Commands that are used for fun.
@@ -14,6 +97,12 @@ class CowSay:
 
     def __init__(self, bot):
         self.bot = bot
+        self.renderer = ProcessPoolExecutor(max_workers=2)
+        # The same messages come up again and again, remember the finished cows
+        self.compose = lru_cache(maxsize=256)(self.compose)
+
+    def __unload(self):
+        self.renderer.shutdown(wait=False)
 
     def _box_text(self, text : str):
         """ Convert text into a box of fixedwidth text. """
@@ -24,38 +113,111 @@ class CowSay:
         text_boxed = '```txt\n{0}```'.format(text_sanitised)
         return text_boxed
 
+    def _split_text(self, text, limit=2000):
+        """ Split text on line breaks into boxes that each fit in a message. """
+        # Lengths are measured as _box_text sends them, the fence included and
+        # every backtick followed by a zero-width space
+        budget = limit - len(self._box_text(""))
+        chunks = []
+        current = []
+        size = 0
+        for line in text.split("\n"):
+            width = len(line) + line.count("`")
+            if width > budget:
+                width = 0
+                for i, char in enumerate(line):
+                    step = 2 if char == "`" else 1
+                    if width + step > budget:
+                        line = line[:i]
+                        break
+                    width += step
+            if current and size + 1 + width > budget:
+                chunks.append("\n".join(current))
+                current = []
+            if current:
+                size += 1 + width
+            else:
+                size = width
+            current.append(line)
+        chunks.append("\n".join(current))
+        return [self._box_text(chunk) for chunk in chunks]
+
+    def _parse_flags(self, message):
+        """ Split leading --image and -f <cow> flags off the message. """
+        image = False
+        cow = None
+        words = message.split(" ")
+        while len(words) > 1:
+            if words[0] == "--image":
+                image = True
+                words = words[1:]
+            elif words[0] == "-f" and len(words) > 2:
+                cow = words[1]
+                words = words[2:]
+            else:
+                break
+        return image, cow, " ".join(words).strip()
+
+    def get_cow(self, name=None):
+        """ The template for a cow from the cowfile directory, or the default cow. """
+        if not name or name == "default":
+            return DEFAULT_COW
+        if not re.fullmatch(r"[\w-]+", name):
+            return None
+        path = os.path.join(COW_DIRECTORY, name + ".cow")
+        try:
+            return load_cowfile(path, os.path.getmtime(path))
+        except (OSError, ValueError):
+            return None
+
+    def compose(self, message, template, thoughts):
+        return self.build_box(message, 40) + fill_cow(template, thoughts)
+
+    async def _make_cow(self, message, thoughts):
+        image, name, message = self._parse_flags(message)
+        template = self.get_cow(name)
+        if template is None:
+            await self.bot.say("I don't know a cow called {}, see cowlist.".format(name))
+            return
+        return await self._send_cow(self.compose(message, template, thoughts), image)
+
+    async def _send_cow(self, cow, image):
+        if not image:
+            for chunk in self._split_text(cow):
+                await self.bot.say(chunk)
+            return
+
+        # Rendering is CPU bound, keep it in another process so the bot stays responsive
+        png = await self.bot.loop.run_in_executor(self.renderer, render_cow, cow)
+        return await self.bot.upload(io.BytesIO(png), filename="cow.png")
+
     @commands.command()
     async def cowthink(self, *, message : str):
-        cow = self.build_box(message, 40) + self.build_thinkcow()
-
-        return await self.bot.say(self._box_text(cow))
+        """ Think it with a cow, add --image to get a picture and -f <cow> to pick a cow. """
+        return await self._make_cow(message, "o")
 
     @commands.command()
     async def cowsay(self, *, message : str):
-        cow = self.build_box(message, 40) + self.build_saycow()
+        """ Say it with a cow, add --image to get a picture and -f <cow> to pick a cow. """
+        return await self._make_cow(message, "\\")
 
-        return await self.bot.say(self._box_text(cow))
+    @commands.command()
+    async def cowlist(self):
+        """ List the cows you can pick with -f. """
+        try:
+            names = sorted(name[:-4] for name in os.listdir(COW_DIRECTORY) if name.endswith(".cow"))
+        except OSError:
+            names = []
+        await self.bot.say("Cows: {}".format(", ".join(["default"] + names))[:2000])
 
 
     # Cowsay code used from https://github.com/jcn/cowsay-py
 
     def build_saycow(self):
-        return """
-         \   ^__^
-          \  (oo)\_______
-             (__)\       )\/\\
-                 ||----w |
-                 ||     ||
-        """
+        return fill_cow(DEFAULT_COW, "\\")
 
     def build_thinkcow(self):
-        return """
-         o   ^__^
-          o  (oo)\_______
-             (__)\       )\/\\
-                 ||----w |
-                 ||     ||
-        """
+        return fill_cow(DEFAULT_COW, "o")
 
     def build_box(self, str, length=40):
         bubble = []
@@ -93,5 +255,11 @@ class CowSay:
         else:
             return [ "|", "|" ]
 
+def check_folder():
+    if not os.path.exists(COW_DIRECTORY):
+        print("Creating {} folder...".format(COW_DIRECTORY))
+        os.makedirs(COW_DIRECTORY)
+
 def setup(bot):
+    check_folder()
     bot.add_cog(CowSay(bot))
@@ -0,0 +1,132 @@
+from discord.ext import commands
+from urllib.parse import urlsplit
+from .utils import checks
+import aiohttp
+import asyncio
+import random
+import time
+
+
+class HTTPStatusError(aiohttp.ClientError):
+    def __init__(self, status, url):
+        super().__init__('{} returned HTTP {}'.format(url, status))
+        self.status = status
+        self.url = url
+
+
+class HostStats:
+    __slots__ = ('requests', 'errors', 'retries', 'total_seconds', 'max_seconds')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests, 'errors': self.errors, 'retries': self.retries,
+            'mean_ms': self.total_seconds / self.requests * 1000 if self.requests else 0,
+            'max_ms': self.max_seconds * 1000}
+
+
+class HTTPClient:
+    """
+    Shared HTTP client for the other cogs
+    """
+
+    PER_HOST_LIMIT = 8
+    TIMEOUT = 10
+    RETRIES = 2
+    BACKOFF = 0.5
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, bot):
+        self.bot = bot
+        # Keep-alive connections and cached DNS lookups are shared by every cog
+        connector = aiohttp.TCPConnector(use_dns_cache=True, keepalive_timeout=30, limit=64, loop=bot.loop)
+        self.session = aiohttp.ClientSession(connector=connector, loop=bot.loop)
+        self.host_slots = {}
+        self.hosts = {}
+
+    def __unload(self):
+        self.session.close()
+
+    def _slot(self, host):
+        slot = self.host_slots.get(host)
+        if slot is None:
+            slot = self.host_slots[host] = asyncio.Semaphore(self.PER_HOST_LIMIT)
+        return slot
+
+    async def request(self, method, url, *, read='text', timeout=None, retries=None, **kwargs):
+        """
+        Make a request and return the body as text, json or bytes
+
+        Connection errors, timeouts and 429/5xx answers are retried with exponential backoff,
+        by default only for GET requests.
+        """
+        host = urlsplit(url).netloc
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = self.hosts[host] = HostStats()
+        if retries is None:
+            retries = self.RETRIES if method == 'GET' else 0
+        timeout = timeout or self.TIMEOUT
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                async with self._slot(host):
+                    return await asyncio.wait_for(self._send(method, url, read, kwargs), timeout)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                stats.errors += 1
+                retry = not isinstance(e, HTTPStatusError) or e.status in self.RETRY_STATUSES
+                if attempt >= retries or not retry:
+                    raise
+            finally:
+                elapsed = time.perf_counter() - started
+                stats.requests += 1
+                stats.total_seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+            stats.retries += 1
+            await asyncio.sleep(self.BACKOFF * (2 ** attempt) * (0.5 + random.random()))
+            attempt += 1
+
+    async def _send(self, method, url, read, kwargs):
+        async with self.session.request(method, url, **kwargs) as resp:
+            if resp.status >= 400:
+                raise HTTPStatusError(resp.status, url)
+            if read == 'json':
+                return await resp.json()
+            elif read == 'bytes':
+                return await resp.read()
+            return await resp.text()
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    def host_stats(self):
+        return {host: stats.as_dict() for host, stats in self.hosts.items()}
+
+    @commands.command()
+    @checks.is_owner()
+    async def httpstats(self):
+        """
+        Show requests, errors and latency per host
+        """
+        if not self.hosts:
+            await self.bot.say('`No requests made yet`')
+            return
+        lines = ['{}: {requests} requests, {errors} errors, {retries} retries, avg {mean_ms:.0f} ms, max {max_ms:.0f} ms'.format(host, **stats)
+                 for host, stats in sorted(self.host_stats().items(), key=lambda item: item[1]['requests'], reverse=True)]
+        await self.bot.say('```\n{}\n```'.format('\n'.join(lines))[:2000])
+
+
+def setup(bot):
+    n = HTTPClient(bot)
+    bot.add_cog(n)
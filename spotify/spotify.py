@@ -1,26 +1,194 @@
 import os
+import gzip
+import json
+import time
+import base64
+import threading
+import asyncio
+import aiohttp
 import discord
+from collections import OrderedDict
 from .utils import checks
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
 
-try:
-    import spotipy
-    from spotipy.oauth2 import SpotifyClientCredentials
-except:
-    spotipy = None
+
+class SearchCache:
+    """LRU cache of search results that expire after a while"""
+
+    def __init__(self, ttl, size, path=None):
+        self.ttl = ttl
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self.loaded = path is None
+        self.dirty = False
+        self.write_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def normalize(query):
+        return ' '.join(query.lower().split())
+
+    def get(self, query):
+        self._load()
+        key = self.normalize(query)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.time():
+            del self.entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, query, tracks):
+        self._load()
+        key = self.normalize(query)
+        self.entries[key] = (time.time() + self.ttl, tracks)
+        self.entries.move_to_end(key)
+        self.dirty = True
+        self.trim()
+
+    def trim(self):
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.loaded = True
+        self.dirty = True
+
+    def persist(self, path):
+        """Start saving to path, whatever is already saved there is read in first."""
+        if path is not None and path != self.path:
+            self.path = path
+            self.loaded = False
+            self._load()
+            self.dirty = True
+        self.path = path
+
+    def _load(self):
+        # Reading the saved cache waits until the first search that needs it
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.path):
+            return
+        saved = OrderedDict()
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                now = time.time()
+                for line in f:
+                    key, expires, tracks = json.loads(line)
+                    if expires > now:
+                        saved[key] = (expires, tracks)
+        except (OSError, ValueError) as e:
+            print('spotify.py: Ignoring unreadable search cache: {}'.format(e))
+        # Searches made since are newer than anything saved, they stay most recently used
+        saved.update(self.entries)
+        self.entries = saved
+        self.trim()
+
+    def lines(self):
+        """The entries to save, taken on the event loop so writing can happen elsewhere."""
+        now = time.time()
+        self.dirty = False
+        return [json.dumps([key, expires, tracks], separators=(',', ':')) + '\n'
+                for key, (expires, tracks) in self.entries.items() if expires > now]
+
+    def write(self, path, lines):
+        # Written aside and swapped in, a crash mid-write leaves the old file intact
+        with self.write_lock:
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+                f.writelines(lines)
+            os.replace(path + '.tmp', path)
+
+    def save(self):
+        if self.path is None or not self.loaded:
+            return
+        self.write(self.path, self.lines())
 
 
 class Spotify:
+    MAX_CONCURRENT_SEARCHES = 4
+    SEARCH_TIMEOUT = 10
+    CACHE_SAVE_INTERVAL = 300
+
     def __init__(self, bot):
         self.bot = bot
         self.settings = dataIO.load_json('data/spotify/settings.json')
+        self.token = None
+        self.token_expires = 0
+        self.token_lock = asyncio.Lock()
+        self.search_slots = asyncio.Semaphore(self.MAX_CONCURRENT_SEARCHES)
+        self.cache = SearchCache(
+            self.settings.get('cache_ttl', 3600), self.settings.get('cache_size', 512),
+            'data/spotify/cache.json.gz' if self.settings.get('cache_persist') else None)
+        self.cache_writer = self.bot.loop.create_task(self._write_cache())
+
+    def __unload(self):
+        self.cache_writer.cancel()
+        self.cache.save()
+
+    async def _write_cache(self):
+        # Red never unloads cogs when it shuts down or restarts, so saving only on unload isn't enough
+        while True:
+            await asyncio.sleep(self.CACHE_SAVE_INTERVAL)
+            cache = self.cache
+            if cache.path is None or not cache.loaded or not cache.dirty:
+                continue
+            try:
+                await self.bot.loop.run_in_executor(None, cache.write, cache.path, cache.lines())
+            except OSError as e:
+                cache.dirty = True
+                print('spotify.py: Failed to save the search cache: {}'.format(e))
+
+    def _http(self):
+        # The shared HTTPClient cog, a missing one fails like any other request would
+        client = self.bot.get_cog('HTTPClient')
+        if client is None:
+            raise aiohttp.ClientError('HTTPClient isn\'t loaded')
+        return client
+
+    async def _get_token(self):
+        # The client credentials token is kept until shortly before it expires
+        async with self.token_lock:
+            if self.token is None or self.token_expires < time.time():
+                credentials = '{}:{}'.format(self.settings['client_id'], self.settings['client_secret'])
+                headers = {'Authorization': 'Basic {}'.format(base64.b64encode(credentials.encode()).decode())}
+                r = await self._http().post(
+                    'https://accounts.spotify.com/api/token', data={'grant_type': 'client_credentials'},
+                    headers=headers, read='json', timeout=self.SEARCH_TIMEOUT)
+                self.token = r['access_token']
+                self.token_expires = time.time() + r['expires_in'] - 60
+            return self.token
 
     async def _api_request(self, query):
-        sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(self.settings['client_id'], self.settings['client_secret']))
-        results = sp.search(query, limit=5, type='track')
+        http = self._http()
+        params = {'q': query, 'type': 'track', 'limit': 5}
+        async with self.search_slots:
+            headers = {'Authorization': 'Bearer {}'.format(await self._get_token())}
+            results = await http.get('https://api.spotify.com/v1/search', params=params, headers=headers, read='json', timeout=self.SEARCH_TIMEOUT)
         return results
 
+    async def _search(self, query):
+        tracks = self.cache.get(query)
+        if tracks is None:
+            r = await self._api_request(query)
+            # Only what the embed shows is kept, the full answer is many times bigger
+            tracks = [[item['name'], item['artists'][0]['name'], item['external_urls']['spotify'], item['preview_url']]
+                      for item in r['tracks']['items'][:5]]
+            self.cache.put(query, tracks)
+        return tracks
+
     async def escape(self, s):
         if s:
             return s.translate(str.maketrans({"[":  r"\[", "]":  r"\]", "(":  r"\(", ")":  r"\)", "{":  r"\{", "}":  r"\}"}))
@@ -33,15 +201,20 @@ class Spotify:
     async def _spotify(self, context, *, query: str):
         """Search for a song on Spotify"""
         if self.settings['client_id'] and self.settings['client_secret']:
-            r = await self._api_request(query)
-            if r['tracks']['total'] > 0:
-                items = r['tracks']['items']
+            try:
+                items = await self._search(query)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                if self.bot.get_cog('HTTPClient') is None:
+                    await self.bot.say('**I can\'t reach Spotify, the HTTPClient cog isn\'t loaded.**')
+                else:
+                    await self.bot.say('**Spotify didn\'t answer in time, please try again later.**')
+                return
+            if items:
                 l = u'\u2063\n'
-                for i, item in enumerate(items, 1):
-                    track = await self.escape(item['name'])
-                    artist = await self.escape(item['artists'][0]['name'])
-                    url = item['external_urls']['spotify']
-                    preview_url = await self.escape(item['preview_url'])
+                for i, (track, artist, url, preview_url) in enumerate(items, 1):
+                    track = await self.escape(track)
+                    artist = await self.escape(artist)
+                    preview_url = await self.escape(preview_url)
                     if i > 5:
                         break
                     l += '{} **[{}]({})** by **{}**\n\n'.format('[:arrow_forward:]({})'.format(preview_url) if preview_url else ':stop_button:', track, url, artist)
@@ -59,9 +232,45 @@ class Spotify:
     async def _spotifyapi(self, client_id: str, client_secret: str):
         self.settings['client_id'] = client_id
         self.settings['client_secret'] = client_secret
+        self.token = None
         await self._save_settings()
         await self.bot.say('Roger that!')
 
+    @commands.group(pass_context=True, name='spotifycache', invoke_without_command=True)
+    @checks.is_owner()
+    async def _spotifycache(self, context):
+        """Show how well the search cache is doing"""
+        cache = self.cache
+        lookups = cache.hits + cache.misses
+        message = ('**Entries:** {}/{}\n**TTL:** {} seconds\n**Hits:** {} ({:.1f}%)\n**Misses:** {}\n'
+                   '**Evictions:** {}\n**Expirations:** {}\n**Saved across restarts:** {}').format(
+            len(cache.entries), cache.size, cache.ttl, cache.hits, cache.hits / lookups * 100 if lookups else 0,
+            cache.misses, cache.evictions, cache.expirations, 'yes' if cache.path else 'no')
+        await self.bot.say(message)
+
+    @_spotifycache.command(name='set')
+    async def _spotifycache_set(self, ttl: int, size: int):
+        """Set how long results are kept (seconds) and how many are kept"""
+        self.settings['cache_ttl'] = self.cache.ttl = max(ttl, 0)
+        self.settings['cache_size'] = self.cache.size = max(size, 0)
+        self.cache.trim()
+        await self._save_settings()
+        await self.bot.say('Roger that!')
+
+    @_spotifycache.command(name='persist')
+    async def _spotifycache_persist(self, enabled: bool):
+        """Keep the cache across restarts"""
+        self.settings['cache_persist'] = enabled
+        self.cache.persist('data/spotify/cache.json.gz' if enabled else None)
+        await self._save_settings()
+        await self.bot.say('Roger that!')
+
+    @_spotifycache.command(name='clear')
+    async def _spotifycache_clear(self):
+        """Forget every cached result"""
+        self.cache.clear()
+        await self.bot.say('Roger that!')
+
 
 def check_folder():
     if not os.path.exists('data/spotify'):
@@ -73,6 +282,9 @@ def check_file():
     data = {}
     data['client_id'] = None
     data['client_secret'] = None
+    data['cache_ttl'] = 3600
+    data['cache_size'] = 512
+    data['cache_persist'] = False
     if not dataIO.is_valid_json('data/spotify/settings.json'):
         print('Creating settings.json...')
         dataIO.save_json('data/spotify/settings.json', data)
@@ -81,7 +293,5 @@ def check_file():
 def setup(bot):
     check_folder()
     check_file()
-    if spotipy is None:
-        raise RuntimeError("You need to run `pip3 install spotipy`")
     n = Spotify(bot)
     bot.add_cog(n)
@@ -1,43 +1,521 @@
 from discord.ext import commands
 from __main__ import send_cmd_help
 from .utils.dataIO import dataIO
+from collections import Counter
+from types import MappingProxyType
+from .utils import checks
 import datetime
+import asyncio
+import heapq
+import threading
+import weakref
 import discord
+import json
+import time
 import os
+import re
 
 try:
     import psutil
 except:
     psutil = False
 
+try:
+    import numpy
+except:
+    numpy = False
+
+
+class MetricRing:
+    """
+    Fixed-size ring of timestamped metric rows backed by preallocated arrays
+    """
+
+    def __init__(self, capacity, width):
+        self.times = numpy.zeros(capacity, dtype=numpy.float64)
+        self.values = numpy.zeros((capacity, width), dtype=numpy.float64)
+        self.capacity = capacity
+        self.index = 0
+        self.count = 0
+
+    def append(self, timestamp, row):
+        self.times[self.index] = timestamp
+        self.values[self.index] = row
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def covers(self, since):
+        # A ring that has never wrapped holds everything it was ever given
+        if self.count < self.capacity:
+            return True
+        return self.times[self.index] <= since
+
+    def window(self, since):
+        times = self.times[:self.count]
+        return self.values[:self.count][times >= since]
+
+
+class MetricHistory:
+    """
+    History of bot metrics at raw sample, minute and hour resolution
+
+    Every resolution is a MetricRing, so memory is fixed no matter how long the bot runs.
+    Counters (I/O, messages and commands) are stored as rates per minute.
+    """
+
+    FIELDS = ('cpu_usage', 'mem_v_mb', 'threads', 'io_reads', 'io_writes', 'read_messages', 'commands_run')
+    RATES = ('io_reads', 'io_writes', 'read_messages', 'commands_run')
+
+    def __init__(self, samples=720, minutes=1440, hours=720):
+        width = len(self.FIELDS)
+        self.rings = [(1, MetricRing(samples, width)), (60, MetricRing(minutes, width)), (3600, MetricRing(hours, width))]
+        self._rate_mask = numpy.array([field in self.RATES for field in self.FIELDS])
+        self._last_time = None
+        self._last_totals = None
+        # Running sum, sample count and bucket number for each rollup ring
+        self._pending = [[numpy.zeros(width), 0, None] for _ in self.rings[1:]]
+
+    def record(self, stats, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        totals = numpy.array([float(stats[field]) for field in self.FIELDS])
+        if self._last_time is None:
+            self._last_time, self._last_totals = timestamp, totals
+            return
+        elapsed = max(timestamp - self._last_time, 1e-6)
+        row = numpy.where(self._rate_mask, (totals - self._last_totals) * 60 / elapsed, totals)
+        self._last_time, self._last_totals = timestamp, totals
+        self.rings[0][1].append(timestamp, row)
+        self._rollup(1, timestamp, row)
+
+    def _rollup(self, level, timestamp, row):
+        if level >= len(self.rings):
+            return
+        period, ring = self.rings[level]
+        pending = self._pending[level - 1]
+        bucket = int(timestamp // period)
+        if pending[2] is not None and bucket != pending[2]:
+            # The bucket is complete, store its mean and hand it to the next resolution
+            finished_time = pending[2] * period
+            finished = pending[0] / pending[1]
+            ring.append(finished_time, finished)
+            pending[0] = numpy.zeros(len(self.FIELDS))
+            pending[1] = 0
+            self._rollup(level + 1, finished_time, finished)
+        pending[0] += row
+        pending[1] += 1
+        pending[2] = bucket
+
+    def summary(self, seconds, now=None):
+        now = time.time() if now is None else now
+        since = now - seconds
+        # Use the finest resolution that still reaches back far enough
+        for period, ring in self.rings:
+            if ring.covers(since):
+                break
+        values = ring.window(since)
+        if not len(values):
+            return {}
+        minimum = values.min(axis=0)
+        average = values.mean(axis=0)
+        maximum = values.max(axis=0)
+        p95 = numpy.percentile(values, 95, axis=0)
+        return {
+            field: {'min': float(minimum[i]), 'avg': float(average[i]), 'max': float(maximum[i]), 'p95': float(p95[i])}
+            for i, field in enumerate(self.FIELDS)}
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed latency histogram in the style of HdrHistogram
+
+    Values are microseconds, bucketed with 8 sub-buckets per power of two (at most 12.5% error).
+    Memory is one fixed array no matter how many values are recorded.
+    """
+
+    SUB_BITS = 3
+    MAX_VALUE = (1 << 32) - 1  # About 71 minutes
+    BUCKETS = (MAX_VALUE.bit_length() - SUB_BITS) * (1 << SUB_BITS) + (1 << SUB_BITS)
+
+    def __init__(self):
+        self.counts = numpy.zeros(self.BUCKETS, dtype=numpy.int64)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        if value < 2 << cls.SUB_BITS:
+            return value
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        return (shift << cls.SUB_BITS) + (value >> shift)
+
+    @classmethod
+    def _lower_bound(cls, index):
+        if index < 2 << cls.SUB_BITS:
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        return ((index & ((1 << cls.SUB_BITS) - 1)) + (1 << cls.SUB_BITS)) << shift
+
+    def record(self, seconds):
+        value = min(max(int(seconds * 1000000), 0), self.MAX_VALUE)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """
+        Lower bound in microseconds of the bucket holding the q-th percentile
+        """
+        if not self.total:
+            return 0
+        rank = max(int(numpy.ceil(self.total * q / 100)), 1)
+        index = int(numpy.searchsorted(numpy.cumsum(self.counts), rank))
+        return self._lower_bound(index)
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0
+
+
+class SpaceSaving:
+    """
+    Approximate top-k counter (Space-Saving) in fixed memory
+
+    At most capacity keys are counted. A new key arriving when full replaces a key with the
+    lowest count and takes over that count as its error, so a count is never below the true
+    count and never above it by more than its error.
+    Keys are grouped in buckets by count, which makes every add O(1).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}  # key: [count, error]
+        self.buckets = {}  # count: {key: None}, oldest first
+        self.min_count = 0
+
+    def add(self, key):
+        entry = self.counts.get(key)
+        old_key = key
+        if entry is None:
+            if len(self.counts) < self.capacity:
+                entry = [0, 0]
+            else:
+                old_key = next(iter(self.buckets[self.min_count]))
+                entry = self.counts.pop(old_key)
+                entry[1] = entry[0]
+            self.counts[key] = entry
+        count = entry[0]
+        if count:
+            bucket = self.buckets[count]
+            del bucket[old_key]
+            if not bucket:
+                del self.buckets[count]
+                if count == self.min_count:
+                    self.min_count = count + 1
+        else:
+            self.min_count = 1
+        entry[0] = count + 1
+        self.buckets.setdefault(count + 1, {})[key] = None
+
+    def top(self, n):
+        return [(key, count, error) for key, (count, error) in heapq.nlargest(n, self.counts.items(), key=lambda item: item[1][0])]
+
+
+class MinuteTopK:
+    """
+    Top keys by count over the last complete minute
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.minute = None
+        self.current = SpaceSaving(capacity)
+        self.last = SpaceSaving(capacity)
+
+    def _roll(self, now):
+        minute = int(now // 60)
+        if minute != self.minute:
+            # A gap of more than a minute means the last complete minute saw nothing
+            self.last = self.current if self.minute == minute - 1 else SpaceSaving(self.capacity)
+            self.current = SpaceSaving(self.capacity)
+            self.minute = minute
+
+    def add(self, key, now=None):
+        self._roll(time.time() if now is None else now)
+        self.current.add(key)
+
+    def top(self, n, now=None):
+        self._roll(time.time() if now is None else now)
+        return self.last.top(n)
+
+
+class CounterJournal:
+    """
+    Lifetime and per-day message and command counts that survive restarts
+
+    Increments are appended to a journal and folded into a snapshot once the journal grows,
+    so loading only ever reads one snapshot and a short journal tail.
+    Every journal entry carries a sequence number, entries already in the snapshot are skipped,
+    so a crash between writing the snapshot and truncating the journal counts nothing twice.
+    """
+
+    FIELDS = ('messages', 'commands')
+
+    def __init__(self, directory, keep_days=400, compact_every=500):
+        self.snapshot_path = os.path.join(directory, 'counters.json')
+        self.journal_path = os.path.join(directory, 'counters.journal')
+        self.keep_days = keep_days
+        self.compact_every = compact_every
+        self.totals = dict.fromkeys(self.FIELDS, 0)
+        self.days = {}
+        self.seq = 0
+        self.pending = []
+        self.journal_entries = 0
+        self.snapshot_seq = 0
+        self.write_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        snapshot_seq = 0
+        if dataIO.is_valid_json(self.snapshot_path):
+            data = dataIO.load_json(self.snapshot_path)
+            self.totals.update(data.get('totals', {}))
+            self.days = data.get('days', {})
+            self.seq = snapshot_seq = data.get('seq', 0)
+        self.snapshot_seq = snapshot_seq
+        if not os.path.exists(self.journal_path):
+            return
+        good = 0
+        with open(self.journal_path, 'r+b') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    seq, day, messages, commands = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                good += len(line)
+                self.journal_entries += 1
+                if seq > snapshot_seq:
+                    self._apply(day, messages, commands)
+                    # Batches can land out of order, see write()
+                    self.seq = max(self.seq, seq)
+            # Cut off a line torn by a crash mid-write so new entries don't get glued onto it
+            f.truncate(good)
+
+    def _apply(self, day, messages, commands):
+        self.totals['messages'] += messages
+        self.totals['commands'] += commands
+        bucket = self.days.setdefault(day, [0, 0])
+        bucket[0] += messages
+        bucket[1] += commands
+
+    def add(self, day, messages, commands):
+        if not messages and not commands:
+            return
+        self._apply(day, messages, commands)
+        self.seq += 1
+        self.pending.append(json.dumps([self.seq, day, messages, commands]) + '\n')
+
+    def day(self, day):
+        messages, commands = self.days.get(day, (0, 0))
+        return {'messages': messages, 'commands': commands}
+
+    def take_batch(self):
+        """
+        Hand the pending entries (and a snapshot when it is time to compact) to write()
+
+        Runs on the event loop so write() can run in an executor without touching live state.
+        """
+        lines, self.pending = self.pending, []
+        self.journal_entries += len(lines)
+        snapshot = None
+        if self.journal_entries >= self.compact_every:
+            for day in sorted(self.days)[:-self.keep_days]:
+                del self.days[day]
+            snapshot = {
+                'seq': self.seq, 'totals': dict(self.totals),
+                'days': {day: list(bucket) for day, bucket in self.days.items()}}
+            self.journal_entries = 0
+        return lines, snapshot
+
+    def write(self, lines, snapshot):
+        """
+        Append lines to the journal and save snapshot, if any
+
+        Batches may be written in any order (an executor flush can still be queued when the cog
+        unloads and writes its last batch), so a snapshot older than the saved one is dropped and
+        compaction only removes journal entries the new snapshot covers.
+        """
+        with self.write_lock:
+            if lines:
+                with open(self.journal_path, 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+            if snapshot is not None and snapshot['seq'] > self.snapshot_seq:
+                dataIO.save_json(self.snapshot_path, snapshot)
+                self.snapshot_seq = snapshot['seq']
+                with open(self.journal_path, encoding='utf-8') as f:
+                    newer = [line for line in f if json.loads(line)[0] > snapshot['seq']]
+                with open(self.journal_path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.writelines(newer)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.journal_path + '.tmp', self.journal_path)
+
 
 class Statistics:
     """
     Statistics
     """
 
+    HISTORY_FIELDS = (
+        ('cpu_usage', 'CPU', '{:.1f}%'), ('mem_v_mb', 'Memory', '{:.0f} MB'), ('threads', 'Threads', '{:.0f}'),
+        ('io_reads', 'Reads per minute', '{:.0f}'), ('io_writes', 'Writes per minute', '{:.0f}'),
+        ('read_messages', 'Messages per minute', '{:.1f}'), ('commands_run', 'Commands per minute', '{:.1f}'))
+    JOURNAL_INTERVAL = 30
+    DASHBOARD_MAX_BACKOFF = 600
+    REBUILD_DELAY = 5
+    TOP_SERVERS = 200
+    TOP_CHANNELS = 500
+
     def __init__(self, bot):
         self.bot = bot
+        self.settings = dataIO.load_json('data/statistics/settings.json')
+        self.refresh_rate = self.settings.get('REFRESH_RATE', 5)
+        self.process = psutil.Process()
+        self.snapshot = None
+        self.history = MetricHistory()
+        self.command_latency = {}
+        self.command_errors = Counter()
+        self._command_starts = weakref.WeakKeyDictionary()
+        self._user_refs = Counter()
+        self._text_channels = 0
+        self._voice_channels = 0
+        self._rebuild_handle = None
+        self._rebuild_counters()
+        self.server_activity = MinuteTopK(self.TOP_SERVERS)
+        self.channel_activity = MinuteTopK(self.TOP_CHANNELS)
+        self.lifetime = CounterJournal('data/statistics')
+        # bot.counter starts at zero with the bot, not with this cog, so only count what comes after loading
+        self._counted = {'messages': self.bot.counter['messages_read'], 'commands': self.bot.counter['processed_commands']}
+        self._sampler = self.bot.loop.create_task(self._sample_loop())
+        self._journal_writer = self.bot.loop.create_task(self._journal_loop())
+        self._dashboard_message = None
+        self._dashboard_sent = None
+        self._dashboard = self.bot.loop.create_task(self._dashboard_loop())
 
     def redapi_hook(self, data=None):
         if not data:
-            x = self.retrieve_statistics()
-            x['avatar'] = self.bot.user.avatar_url if self.bot.user.avatar else self.bot.user.default_avatar_url
-            x['uptime'] = self.get_bot_uptime(brief=False)
-            x['total_cogs'] = len(self.bot.cogs)
-            x['total_commands'] = len(self.bot.commands)
-            x['discord_version'] = str(discord.__version__)
-            x['id'] = self.bot.user.id
-            x['discriminator'] = self.bot.user.discriminator
-            x['created_at'] = self.bot.user.created_at.strftime('%B %d, %Y at %H:%M:%S')
-            x['loaded_cogs'] = [cog for cog in self.bot.cogs]
-            x['prefixes'] = self.bot.settings.prefixes
-            x['servers'] = [{'name': server.name, 'members': len(server.members), 'icon_url': server.icon_url} for server in self.bot.servers]
-            x['cogs'] = len(self.bot.cogs)
-            return x
+            return dict(self.get_snapshot())
         else:
             pass
 
+    def get_snapshot(self):
+        """
+        Latest immutable statistics snapshot, taken by the background sampler
+        """
+        if self.snapshot is None:
+            # Only happens when asked before the first sample has run
+            self.snapshot = self._take_snapshot()
+        return self.snapshot
+
+    def _take_snapshot(self, record=False):
+        x = self.retrieve_statistics()
+        if record:
+            self.history.record(x)
+        x['avatar'] = self.bot.user.avatar_url if self.bot.user.avatar else self.bot.user.default_avatar_url
+        x['uptime'] = self.get_bot_uptime(brief=False)
+        x['total_cogs'] = len(self.bot.cogs)
+        x['total_commands'] = len(self.bot.commands)
+        x['discord_version'] = str(discord.__version__)
+        x['id'] = self.bot.user.id
+        x['discriminator'] = self.bot.user.discriminator
+        x['created_at'] = self.bot.user.created_at.strftime('%B %d, %Y at %H:%M:%S')
+        x['loaded_cogs'] = [cog for cog in self.bot.cogs]
+        x['prefixes'] = self.bot.settings.prefixes
+        x['servers'] = [{'name': server.name, 'members': len(server.members), 'icon_url': server.icon_url} for server in self.bot.servers]
+        x['cogs'] = len(self.bot.cogs)
+        x['history'] = self.history.summary(3600)
+        x['command_timings'] = self._command_timings()
+        x['slowest_commands'] = sorted(x['command_timings'].items(), key=lambda item: item[1]['p95_ms'], reverse=True)[:5]
+        http = self.bot.get_cog('HTTPClient')
+        x['http_hosts'] = http.host_stats() if http else {}
+        x['top_servers'] = self._top_servers()
+        x['top_channels'] = self._top_channels()
+        self._count_lifetime()
+        x['lifetime_messages'] = self.lifetime.totals['messages']
+        x['lifetime_commands'] = self.lifetime.totals['commands']
+        today = self.lifetime.day(self._today())
+        x['today_messages'] = today['messages']
+        x['today_commands'] = today['commands']
+        x['timestamp'] = datetime.datetime.utcnow()
+        return MappingProxyType(x)
+
+    async def _sample_loop(self):
+        await self.bot.wait_until_ready()
+        # Prime the per-process CPU counter so the first sample covers an interval
+        self.process.cpu_percent()
+        while True:
+            await asyncio.sleep(self.refresh_rate or 5)
+            try:
+                self.snapshot = self._take_snapshot(record=True)
+            except Exception as e:
+                print('statistics.py: Failed to sample metrics: {}'.format(e))
+            else:
+                self.bot.dispatch('statistics_snapshot', self.snapshot)
+
+    def _top_servers(self, n=10):
+        top = []
+        for server_id, count, error in self.server_activity.top(n):
+            server = self.bot.get_server(server_id)
+            top.append({
+                'id': server_id, 'name': server.name if server else server_id,
+                'messages_per_minute': count, 'error': error})
+        return top
+
+    def _top_channels(self, n=10):
+        top = []
+        for channel_id, count, error in self.channel_activity.top(n):
+            channel = self.bot.get_channel(channel_id)
+            name = '#{} ({})'.format(channel.name, channel.server.name) if channel else channel_id
+            top.append({'id': channel_id, 'name': name, 'messages_per_minute': count, 'error': error})
+        return top
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+    def _count_lifetime(self):
+        messages = self.bot.counter['messages_read']
+        commands = self.bot.counter['processed_commands']
+        self.lifetime.add(self._today(), messages - self._counted['messages'], commands - self._counted['commands'])
+        self._counted = {'messages': messages, 'commands': commands}
+
+    async def _journal_loop(self):
+        while True:
+            await asyncio.sleep(self.JOURNAL_INTERVAL)
+            self._count_lifetime()
+            batch = self.lifetime.take_batch()
+            try:
+                await self.bot.loop.run_in_executor(None, self.lifetime.write, *batch)
+            except OSError as e:
+                print('statistics.py: Failed to write the counter journal: {}'.format(e))
+
+    async def _save_settings(self):
+        await self.bot.loop.run_in_executor(None, dataIO.save_json, 'data/statistics/settings.json', dict(self.settings))
+
+    def __unload(self):
+        self._sampler.cancel()
+        self._journal_writer.cancel()
+        self._dashboard.cancel()
+        if self._rebuild_handle is not None:
+            self._rebuild_handle.cancel()
+        # Whatever has not been flushed yet is written before the cog goes away
+        self._count_lifetime()
+        self.lifetime.write(*self.lifetime.take_batch())
+
     @commands.command()
     async def stats(self):
         """
@@ -46,6 +524,40 @@ class Statistics:
         message = await self.embed_statistics()
         await self.bot.say(embed=message)
 
+    @commands.command(pass_context=True)
+    async def statshistory(self, context, window: str='1h'):
+        """
+        Show min/avg/max/p95 of the bot metrics over a window
+
+        Example: [p]statshistory 30m
+
+        Windows can be given in s, m, h or d. Default: 1h
+        """
+        seconds = self._parse_window(window)
+        if not seconds:
+            await send_cmd_help(context)
+            return
+        summary = self.history.summary(seconds)
+        if not summary:
+            await self.bot.say('`No history has been recorded yet`')
+            return
+        em = discord.Embed(description=u'\u2063\n', color=discord.Color.red())
+        em.set_author(name='History of the last {}'.format(window))
+        for field, label, fmt in self.HISTORY_FIELDS:
+            values = summary[field]
+            if field == 'mem_v_mb':
+                values = {key: value / 1024 / 1024 for key, value in values.items()}
+            text = 'min {0} / avg {1} / max {2} / p95 {3}'.format(
+                *[fmt.format(values[key]) for key in ('min', 'avg', 'max', 'p95')])
+            em.add_field(name='**{}**'.format(label), value=text, inline=False)
+        await self.bot.say(embed=em)
+
+    def _parse_window(self, window):
+        match = re.fullmatch(r'(\d+)([smhd]?)', window.lower())
+        if not match:
+            return None
+        return int(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+
     @commands.command(pass_context=True)
     async def statsrefresh(self, context, seconds: int=0):
         """
@@ -67,18 +579,110 @@ class Statistics:
         else:
             self.refresh_rate = seconds
             self.settings['REFRESH_RATE'] = self.refresh_rate
-            dataIO.save_json('data/statistics/settings.json', self.settings)
+            await self._save_settings()
             message = '`Changed refresh rate to {} seconds`'.format(
                 self.refresh_rate)
         await self.bot.say(message)
 
-    async def embed_statistics(self):
-        stats = self.retrieve_statistics()
+    @commands.command()
+    @checks.is_owner()
+    async def statsverify(self):
+        """
+        Compare the live counters against a full scan
+
+        Rebuilds the counters if they have drifted.
+        """
+        mismatches = self._verify_counters()
+        if mismatches:
+            lines = ['{}: counted {}, scanned {}'.format(key, counted, scanned) for key, (counted, scanned) in mismatches.items()]
+            self._rebuild_counters()
+            message = '```\n{}\n```Counters have been rebuilt.'.format('\n'.join(lines))
+        else:
+            message = '`Counters match a full scan`'
+        await self.bot.say(message)
+
+    async def _dashboard_loop(self):
+        await self.bot.wait_until_ready()
+        backoff = 0
+        while True:
+            await asyncio.sleep((self.refresh_rate or 5) + backoff)
+            channel = self.bot.get_channel(self.settings.get('CHANNEL_ID'))
+            if channel is None:
+                continue
+            em = await self.embed_statistics(dashboard=True)
+            content = em.to_dict()
+            # Only the newest state is ever sent, anything in between is simply skipped
+            if content == self._dashboard_sent:
+                continue
+            try:
+                await self._update_dashboard(channel, em)
+            except discord.HTTPException as e:
+                if e.response.status == 429:
+                    backoff = min(backoff * 2 or self.refresh_rate or 5, self.DASHBOARD_MAX_BACKOFF)
+                else:
+                    print('statistics.py: Failed to update the dashboard: {}'.format(e))
+                    backoff = self.DASHBOARD_MAX_BACKOFF
+            else:
+                self._dashboard_sent = content
+                backoff = 0
+
+    async def _update_dashboard(self, channel, em):
+        message = self._dashboard_message
+        if message is None and self.settings.get('DASHBOARD_MESSAGE_ID'):
+            try:
+                message = await self.bot.get_message(channel, self.settings['DASHBOARD_MESSAGE_ID'])
+            except discord.NotFound:
+                message = None
+        if message is not None:
+            try:
+                self._dashboard_message = await self.bot.edit_message(message, embed=em)
+                return
+            except discord.NotFound:
+                # Someone deleted the dashboard, post a new one
+                pass
+        self._dashboard_message = await self.bot.send_message(channel, embed=em)
+        self.settings['DASHBOARD_MESSAGE_ID'] = self._dashboard_message.id
+        await self._save_settings()
+        try:
+            await self.bot.pin_message(self._dashboard_message)
+        except discord.HTTPException:
+            pass
+
+    @commands.command()
+    @checks.is_owner()
+    async def statsdashboard(self, channel: discord.Channel=None):
+        """
+        Keep a pinned statistics message up to date in a channel
+
+        Example: [p]statsdashboard #stats
+
+        Leave the channel out to stop updating the dashboard.
+        """
+        self.settings['CHANNEL_ID'] = channel.id if channel else None
+        self.settings['DASHBOARD_MESSAGE_ID'] = None
+        self._dashboard_message = None
+        self._dashboard_sent = None
+        await self._save_settings()
+        if channel:
+            message = '`The dashboard will appear in #{} within {} seconds`'.format(channel.name, self.refresh_rate)
+        else:
+            message = '`Stopped updating the dashboard`'
+        await self.bot.say(message)
+
+    async def embed_statistics(self, dashboard=False):
+        stats = self.get_snapshot()
         em = discord.Embed(description=u'\u2063\n', color=discord.Color.red())
-        avatar = self.bot.user.avatar_url if self.bot.user.avatar else self.bot.user.default_avatar_url
-        em.set_author(name='Statistics of {}'.format(stats['name']), icon_url=avatar)
+        em.set_author(name='Statistics of {}'.format(stats['name']), icon_url=stats['avatar'])
 
-        em.add_field(name='**Uptime**', value='{}'.format(self.get_bot_uptime(brief=True)))
+        # The dashboard is only edited when something on it changes, so it sticks to values that
+        # move slowly: no seconds, counts in thousands, rounded CPU and memory, no live top lists
+        if dashboard:
+            def count(n):
+                return '{:.0f}k'.format(n / 1000)
+        else:
+            count = str
+
+        em.add_field(name='**Uptime**', value='{}'.format(self.get_bot_uptime(brief=True, show_seconds=not dashboard)))
 
         em.add_field(name='**Users**', value=stats['users'])
         em.add_field(name='**Servers**', value=stats['total_servers'])
@@ -87,46 +691,68 @@ class Statistics:
         em.add_field(name='**Text channels**', value=str(stats['text_channels']))
         em.add_field(name='**Voice channels**', value=str(stats['voice_channels']))
 
-        em.add_field(name='**Messages received**', value=str(stats['read_messages']))
-        em.add_field(name='**Commands run**', value=str(stats['commands_run']))
+        em.add_field(name='**Messages received**', value=count(stats['read_messages']))
+        em.add_field(name='**Commands run**', value=count(stats['commands_run']))
         em.add_field(name=u'\u2063', value=u'\u2063')
 
-        em.add_field(name='**Active cogs**', value=str(len(self.bot.cogs)))
-        em.add_field(name='**Commands**', value=str(len(self.bot.commands)))
+        em.add_field(name='**Messages today**', value=count(stats['today_messages']))
+        em.add_field(name='**Commands today**', value=count(stats['today_commands']))
+        em.add_field(name='**All time**', value='{} messages\n{} commands'.format(count(stats['lifetime_messages']), count(stats['lifetime_commands'])))
+
+        em.add_field(name='**Active cogs**', value=str(stats['total_cogs']))
+        em.add_field(name='**Commands**', value=str(stats['total_commands']))
         em.add_field(name=u'\u2063', value=u'\u2063')
 
+        if stats['slowest_commands'] and not dashboard:
+            lines = ['`{}` p95 {:.0f} ms, avg {:.0f} ms ({} runs, {} errors)'.format(
+                name, timing['p95_ms'], timing['mean_ms'], timing['count'], timing['errors'])
+                for name, timing in stats['slowest_commands']]
+            em.add_field(name='**Slowest commands**', value='\n'.join(lines), inline=False)
+
+        for key, label in (('top_servers', 'Busiest servers'), ('top_channels', 'Busiest channels')):
+            if stats[key] and not dashboard:
+                lines = ['`{name}` {messages_per_minute}/min'.format(**entry) for entry in stats[key][:5]]
+                em.add_field(name='**{}**'.format(label), value='\n'.join(lines), inline=False)
+
+        if stats['http_hosts'] and not dashboard:
+            busiest = sorted(stats['http_hosts'].items(), key=lambda item: item[1]['requests'], reverse=True)[:5]
+            lines = ['`{}` {requests} requests, avg {mean_ms:.0f} ms, {errors} errors'.format(host, **host_stats)
+                     for host, host_stats in busiest]
+            em.add_field(name='**HTTP hosts**', value='\n'.join(lines), inline=False)
+
         em.add_field(name=u'\u2063', value=u'\u2063', inline=False)
-        em.add_field(name='**CPU**', value='{0:.1f}%'.format(stats['cpu_usage']))
-        em.add_field(name='**Memory**', value='{0:.0f} MB ({1:.2f}%)'.format(stats['mem_v_mb'] / 1024 / 1024, stats['mem_v']))
+        if dashboard:
+            em.add_field(name='**CPU**', value='~{0:.0f}%'.format(round(stats['cpu_usage'], -1)))
+            em.add_field(name='**Memory**', value='~{0:.0f} MB'.format(round(stats['mem_v_mb'] / 1024 / 1024 / 10) * 10))
+        else:
+            em.add_field(name='**CPU**', value='{0:.1f}%'.format(stats['cpu_usage']))
+            em.add_field(name='**Memory**', value='{0:.0f} MB ({1:.2f}%)'.format(stats['mem_v_mb'] / 1024 / 1024, stats['mem_v']))
         em.add_field(name='**Threads**', value='{}'.format(stats['threads']))
         em.set_footer(text='API version {}'.format(discord.__version__))
         return em
 
     def retrieve_statistics(self):
         name = self.bot.user.name
-        users = str(len(set(self.bot.get_all_members())))
+        users = str(len(self._user_refs))
         servers = str(len(self.bot.servers))
         commands_run = self.bot.counter['processed_commands']
         read_messages = self.bot.counter['messages_read']
-        text_channels = 0
-        voice_channels = 0
-
-        process = psutil.Process()
+        text_channels = self._text_channels
+        voice_channels = self._voice_channels
 
-        cpu_usage = psutil.cpu_percent()
+        process = self.process
 
-        mem_v = process.memory_percent()
-        mem_v_mb = process.memory_full_info().uss
-        threads = process.num_threads()
+        # One oneshot() block reads each /proc file once for all the values below
+        with process.oneshot():
+            cpu_usage = process.cpu_percent()
+            mem_v = process.memory_percent()
+            mem_v_mb = process.memory_full_info().uss
+            threads = process.num_threads()
+            io_counters = process.io_counters()
 
-        io_reads = process.io_counters().read_count
-        io_writes = process.io_counters().write_count
+        io_reads = io_counters.read_count
+        io_writes = io_counters.write_count
 
-        for channel in self.bot.get_all_channels():
-            if channel.type == discord.ChannelType.text:
-                text_channels += 1
-            elif channel.type == discord.ChannelType.voice:
-                voice_channels += 1
         channels = text_channels + voice_channels
 
         stats = {
@@ -137,7 +763,139 @@ class Statistics:
             'io_reads': io_reads, 'io_writes': io_writes}
         return stats
 
-    def get_bot_uptime(self, *, brief=False):
+    def _scan_counts(self):
+        # The full O(members + channels) scan the counters replace
+        text_channels = 0
+        voice_channels = 0
+        for channel in self.bot.get_all_channels():
+            if channel.type == discord.ChannelType.text:
+                text_channels += 1
+            elif channel.type == discord.ChannelType.voice:
+                voice_channels += 1
+        return {
+            'users': len(set(member.id for member in self.bot.get_all_members())),
+            'text_channels': text_channels, 'voice_channels': voice_channels}
+
+    def _schedule_rebuild(self):
+        # An outage flips many servers at once, they all share the one rescan already scheduled
+        if self._rebuild_handle is None:
+            self._rebuild_handle = self.bot.loop.call_later(self.REBUILD_DELAY, self._rebuild_counters)
+
+    def _rebuild_counters(self):
+        if self._rebuild_handle is not None:
+            # Covers anything that was waiting for a scheduled rescan
+            self._rebuild_handle.cancel()
+            self._rebuild_handle = None
+        self._user_refs = Counter()
+        self._text_channels = 0
+        self._voice_channels = 0
+        for server in self.bot.servers:
+            self._add_server(server)
+
+    def _verify_counters(self):
+        counted = {
+            'users': len(self._user_refs), 'text_channels': self._text_channels,
+            'voice_channels': self._voice_channels}
+        scanned = self._scan_counts()
+        return {key: (counted[key], scanned[key]) for key in counted if counted[key] != scanned[key]}
+
+    def _add_member(self, member):
+        self._user_refs[member.id] += 1
+
+    def _remove_member(self, member):
+        refs = self._user_refs[member.id] - 1
+        if refs > 0:
+            self._user_refs[member.id] = refs
+        else:
+            del self._user_refs[member.id]
+
+    def _count_channel(self, channel, step):
+        if channel.type == discord.ChannelType.text:
+            self._text_channels += step
+        elif channel.type == discord.ChannelType.voice:
+            self._voice_channels += step
+
+    def _add_server(self, server):
+        for member in server.members:
+            self._add_member(member)
+        for channel in server.channels:
+            self._count_channel(channel, 1)
+
+    def _remove_server(self, server):
+        for member in server.members:
+            self._remove_member(member)
+        for channel in server.channels:
+            self._count_channel(channel, -1)
+
+    def _command_timings(self):
+        return {
+            name: {
+                'count': histogram.total, 'errors': self.command_errors[name],
+                'mean_ms': histogram.mean() / 1000, 'p50_ms': histogram.percentile(50) / 1000,
+                'p95_ms': histogram.percentile(95) / 1000, 'p99_ms': histogram.percentile(99) / 1000,
+                'max_ms': histogram.max / 1000}
+            for name, histogram in self.command_latency.items()}
+
+    def _finish_command(self, command, ctx):
+        started = self._command_starts.pop(ctx, None)
+        if started is None:
+            return
+        name = command.qualified_name
+        histogram = self.command_latency.get(name)
+        if histogram is None:
+            histogram = self.command_latency[name] = LatencyHistogram()
+        histogram.record(time.perf_counter() - started)
+
+    async def on_message(self, message):
+        if message.server is None:
+            return
+        self.server_activity.add(message.server.id)
+        self.channel_activity.add(message.channel.id)
+
+    async def on_command(self, command, ctx):
+        self._command_starts[ctx] = time.perf_counter()
+
+    async def on_command_completion(self, command, ctx):
+        self._finish_command(command, ctx)
+
+    async def on_command_error(self, error, ctx):
+        if ctx.command is None or ctx not in self._command_starts:
+            return
+        self.command_errors[ctx.command.qualified_name] += 1
+        self._finish_command(ctx.command, ctx)
+
+    async def on_ready(self):
+        # Reconnects replace every server object, so start over
+        self._rebuild_counters()
+
+    async def on_member_join(self, member):
+        self._add_member(member)
+
+    async def on_member_remove(self, member):
+        self._remove_member(member)
+
+    async def on_server_join(self, server):
+        self._add_server(server)
+
+    async def on_server_remove(self, server):
+        self._remove_server(server)
+
+    async def on_server_available(self, server):
+        # The available server replaces the stale object, rescan once things settle down
+        self._schedule_rebuild()
+
+    async def on_server_unavailable(self, server):
+        self._schedule_rebuild()
+
+    async def on_channel_create(self, channel):
+        if not channel.is_private:
+            self._count_channel(channel, 1)
+
+    async def on_channel_delete(self, channel):
+        if not channel.is_private:
+            self._count_channel(channel, -1)
+
+    def get_bot_uptime(self, *, brief=False, show_seconds=True):
         # Stolen from owner.py - Courtesy of Danny
         now = datetime.datetime.utcnow()
         delta = now - self.bot.uptime
@@ -151,7 +909,7 @@ class Statistics:
             else:
                 fmt = '{h} hours, {m} minutes, and {s} seconds'
         else:
-            fmt = '{h} H - {m} M - {s} S'
+            fmt = '{h} H - {m} M - {s} S' if show_seconds else '{h} H - {m} M'
             if days:
                 fmt = '{d} D - ' + fmt
 
@@ -168,6 +926,7 @@ def check_file():
     data = {}
     data['CHANNEL_ID'] = None
     data['REFRESH_RATE'] = 5
+    data['DASHBOARD_MESSAGE_ID'] = None
     f = 'data/statistics/settings.json'
     if not dataIO.is_valid_json(f):
         print('Creating default settings.json...')
@@ -177,6 +936,8 @@ def check_file():
 def setup(bot):
     if psutil is False:
         raise RuntimeError('psutil is not installed. Run `pip3 install psutil --upgrade` to use this cog.')
+    elif numpy is False:
+        raise RuntimeError('numpy is not installed. Run `pip3 install numpy --upgrade` to use this cog.')
     else:
         check_folder()
         check_file()
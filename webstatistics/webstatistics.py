@@ -1,37 +1,92 @@
 from cogs.utils.dataIO import dataIO
+from collections import namedtuple
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from aiohttp import web
+import aiohttp
 import datetime
+import calendar
+import base64
+import html
+import math
+import hashlib
 import asyncio
+import gzip
+import json
+import time
 import os
 
-try:
-    import ipgetter
-    has_ipgetter = True
-except:
-    has_ipgetter = False
+web_template = """<html><header> <link href="https://fonts.googleapis.com/css?family=Assistant:300,400,600,700" rel="stylesheet"> <style type="text/css"> body{{background-color: rgb(16%, 18%, 20%); color: rgb(58%, 59%, 60%); font-family: 'Assistant', sans-serif; font-weight: 300; font-size: 18px;}}.avatar{{box-shadow: rgba(255, 255, 255, 0.2) 0px 0px 5px 0px; height: 80px; width: 80px; border-radius: 50% 50% 50% 50%; padding: 4px;}}.avatar img{{height: 80px; width: 80px; border-radius: 50% 50% 50% 50%; border: none; outline: none; background-color: #7289DA;}}.big-thing{{background-color: rgb(21%, 22%, 24%); width: 1080px; margin: 0 auto; margin-top: 15px; padding: 30px; border-radius: 5px 5px 5px 5px; box-shadow: rgba(0, 0, 0, 0.1) 0px 1px 10px 0px;}}.title-thing{{padding-top: 15px; margin: 0 auto; width: 1110px;}}.title-thing h4{{color: #fff; font-weight: 600; font-size: 32px; line-height: 34px;}}.title-thing-two h4{{color: #fff; font-size: 18px; padding: 0 0 0 0; font-weight: 300;}}.servers{{width: 1140px; margin: 0 auto; padding-top: 15px; display: grid; grid-gap: 10px; grid-template-columns: repeat(3, 373px);}}.server{{background-color: rgb(21%, 22%, 24%); border-radius: 5px 5px 5px 5px; box-shadow: rgba(0, 0, 0, 0.1) 0px 1px 10px 0px; padding: 15px; padding-bottom: 0; height: 105px;}}.server .title{{position: relative; left: 35%; top: -50%; font-size: 18px; letter-spacing: 0.8px; font-weight: 400; color: #ddd; line-height: 20px; width: 220px; height: 80x;}}.bot-information{{display: grid; grid-gap: 10px; grid-template-columns: repeat(2, 400px);}}footer{{text-align: center; padding: 40px 0 40px; font-size: 11px;}}.other-thing{{width: 600px;}}.system-information{{display: grid; grid-gap: 10px; grid-template-columns: repeat(3, 363px);}}p{{color: hsla(0,0%,100%,.5); font-size: 18px; font-weight: 400; text-indent: 4px;}}.bold{{font-weight: 600;}}.white{{color: #ddd;}}</style> <title>{name}- Web Statistics</title></header><body> <div class="title-thing"> <h4>Web Statistics Status Page</h4> </div><div class="big-thing bot-information"> <div class="other-thing"> <div class="avatar"> <img src="{bot_avatar_icon_url}" alt=''/> </div></div><div class="other-thing"> <p> <span class="white bold">Name: </span>{name}<p> <p> <span class="white bold">Owner: </span>{owner}</p><p> <span class="white bold">Created: </span>{created}</p><p> <span class="white bold">Uptime: </span><span id="uptime">{uptime}</span></p></div></div><div class="title-thing"> <h4>Bot Information</h4> </div><div class="big-thing system-information"> <div class="other-thing"> <div class="title-thing-two"> <h4>Servers</h4> </div><p id="total_servers">{total_servers}</p><div class="title-thing-two"> <h4>Users</h4> </div><p id="user_count">{user_count}</p><div class="title-thing-two"> <h4>Active Cogs</h4> </div><p>{active_cogs}</p><div class="title-thing-two"> <h4>Commands</h4> </div><p>{total_commands}</p></div><div class="other-thing"> <div class="title-thing-two"> <h4>Channels</h4> </div><p id="total_channels">{total_channels}</p><div class="title-thing-two"> <h4>Text</h4> </div><p id="text_channels">{text_channels}</p><div class="title-thing-two"> <h4>Voice</h4> </div><p id="voice_channels">{voice_channels}</p><div class="title-thing-two"> <h4>Messages Received</h4> </div><p id="messages_received">{messages_received}</p><div class="title-thing-two"> <h4>Commands Run</h4> </div><p id="commands_run">{commands_run}</p></div><div class="other-thing"> <div class="title-thing-two"> <h4>CPU</h4> </div><p id="cpu_usage">{cpu_usage:.1f}%</p><div class="title-thing-two"> <h4>Memory</h4> </div><p id="memory">{memory_usage_mb:.0f}MB ({memory_usage:.1f}%)</p><div class="title-thing-two"> <h4>Threads</h4> </div><p id="threads">{threads}</p><div class="title-thing-two"> <h4>I/O</h4> </div><p><span class="white">Total reads: </span><span id="io_reads">{io_reads}</span></p><p><span class="white ">Total writes: </span><span id="io_writes">{io_writes}</span></p></div></div><div class="title-thing"> <h4>Busiest Servers</h4> </div><div class="big-thing system-information">{top_servers}</div><div class="title-thing"> <h4>Busiest Channels</h4> </div><div class="big-thing system-information">{top_channels}</div><div class="title-thing"> <h4>Loaded Cogs</h4> </div><div class="big-thing system-information">{loaded_cogs}</div><div class="title-thing"> <h4>Available Commands</h4> </div><div class="big-thing system-information">{all_commands}</div><div class="title-thing"> <h4>Servers</h4> </div><div class="servers">{servers}</div><div class="title-thing"><p>{server_pages}</p></div><footer>{date_now}</footer><script>var live=new EventSource('/live');live.addEventListener('stats', function(e){{var data=JSON.parse(e.data);for(var id in data){{var el=document.getElementById(id);if(el){{el.textContent=data[id];}}}}}});</script></body></html>"""
 
-web_template = """<html><header> <link href="https://fonts.googleapis.com/css?family=Assistant:300,400,600,700" rel="stylesheet"> <style type="text/css"> body{{background-color: rgb(16%, 18%, 20%); color: rgb(58%, 59%, 60%); font-family: 'Assistant', sans-serif; font-weight: 300; font-size: 18px;}}.avatar{{box-shadow: rgba(255, 255, 255, 0.2) 0px 0px 5px 0px; height: 80px; width: 80px; border-radius: 50% 50% 50% 50%; padding: 4px;}}.avatar img{{height: 80px; width: 80px; border-radius: 50% 50% 50% 50%; border: none; outline: none; background-color: #7289DA;}}.big-thing{{background-color: rgb(21%, 22%, 24%); width: 1080px; margin: 0 auto; margin-top: 15px; padding: 30px; border-radius: 5px 5px 5px 5px; box-shadow: rgba(0, 0, 0, 0.1) 0px 1px 10px 0px;}}.title-thing{{padding-top: 15px; margin: 0 auto; width: 1110px;}}.title-thing h4{{color: #fff; font-weight: 600; font-size: 32px; line-height: 34px;}}.title-thing-two h4{{color: #fff; font-size: 18px; padding: 0 0 0 0; font-weight: 300;}}.servers{{width: 1140px; margin: 0 auto; padding-top: 15px; display: grid; grid-gap: 10px; grid-template-columns: repeat(3, 373px);}}.server{{background-color: rgb(21%, 22%, 24%); border-radius: 5px 5px 5px 5px; box-shadow: rgba(0, 0, 0, 0.1) 0px 1px 10px 0px; padding: 15px; padding-bottom: 0; height: 105px;}}.server .title{{position: relative; left: 35%; top: -50%; font-size: 18px; letter-spacing: 0.8px; font-weight: 400; color: #ddd; line-height: 20px; width: 220px; height: 80x;}}.bot-information{{display: grid; grid-gap: 10px; grid-template-columns: repeat(2, 400px);}}footer{{text-align: center; padding: 40px 0 40px; font-size: 11px;}}.other-thing{{width: 600px;}}.system-information{{display: grid; grid-gap: 10px; grid-template-columns: repeat(3, 363px);}}p{{color: hsla(0,0%,100%,.5); font-size: 18px; font-weight: 400; text-indent: 4px;}}.bold{{font-weight: 600;}}.white{{color: #ddd;}}</style> <title>{name}- Web Statistics</title></header><body> <div class="title-thing"> <h4>Web Statistics Status Page</h4> </div><div class="big-thing bot-information"> <div class="other-thing"> <div class="avatar"> <img src="{bot_avatar_icon_url}" alt=''/> </div></div><div class="other-thing"> <p> <span class="white bold">Name: </span>{name}<p> <p> <span class="white bold">Owner: </span>{owner}</p><p> <span class="white bold">Created: </span>{created}</p><p> <span class="white bold">Uptime: </span>{uptime}</p></div></div><div class="title-thing"> <h4>Bot Information</h4> </div><div class="big-thing system-information"> <div class="other-thing"> <div class="title-thing-two"> <h4>Servers</h4> </div><p>{total_servers}</p><div class="title-thing-two"> <h4>Users</h4> </div><p>{user_count}</p><div class="title-thing-two"> <h4>Active Cogs</h4> </div><p>{active_cogs}</p><div class="title-thing-two"> <h4>Commands</h4> </div><p>{total_commands}</p></div><div class="other-thing"> <div class="title-thing-two"> <h4>Channels</h4> </div><p>{total_channels}</p><div class="title-thing-two"> <h4>Text</h4> </div><p>{text_channels}</p><div class="title-thing-two"> <h4>Voice</h4> </div><p>{voice_channels}</p><div class="title-thing-two"> <h4>Messages Received</h4> </div><p>{messages_received}</p><div class="title-thing-two"> <h4>Commands Run</h4> </div><p>{commands_run}</p></div><div class="other-thing"> <div class="title-thing-two"> <h4>CPU</h4> </div><p>{cpu_usage:.1f}%</p><div class="title-thing-two"> <h4>Memory</h4> </div><p>{memory_usage_mb:.0f}MB ({memory_usage:.1f}%)</p><div class="title-thing-two"> <h4>Threads</h4> </div><p>{threads}</p><div class="title-thing-two"> <h4>I/O</h4> </div><p><span class="white">Total reads: </span>{io_reads}</p><p><span class="white ">Total writes: </span>{io_writes}</p></div></div><div class="title-thing"> <h4>Loaded Cogs</h4> </div><div class="big-thing system-information">{loaded_cogs}</div><div class="title-thing"> <h4>Available Commands</h4> </div><div class="big-thing system-information">{all_commands}</div><div class="title-thing"> <h4>Servers</h4> </div><div class="servers">{servers}</div><footer>{date_now}</footer></body></html>"""
+PLACEHOLDER_ICON = base64.b64decode('R0lGODlhAQABAPcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACH5BAEAAP8ALAAAAAABAAEAAAgEAP8FBAA7')
+
+RenderedPage = namedtuple('RenderedPage', 'timestamp body gzipped content_type etag last_modified modified_since')
 
 
 class WebStatistics:
+    OWNER_TTL = 3600
+    SERVERS_PER_PAGE = 90
+    SERVER_SORTS = ('members', 'name')
+    STREAM_THRESHOLD = 256 * 1024
+    CHUNK_SIZE = 64 * 1024
+    LIVE_QUEUE_SIZE = 8
+    SHUTDOWN_TIMEOUT = 5
+
     def __init__(self, bot):
         self.bot = bot
         self.server = None
         self.app = web.Application()
         self.handler = None
         self.dispatcher = {}
+        self._owner = None
+        self._owner_fetched = 0
+        self._pages = {}
+        self._pages_timestamp = None
+        self._sorted_servers = {}
+        self._page_lock = asyncio.Lock()
+        self._live_clients = set()
+        self._live_state = {}
+        self._live_full = None
         self.settings = dataIO.load_json('data/webstatistics/settings.json')
-        self.ip = ipgetter.myip()
+        self.ip = None
         self.port = self.settings['server_port']
-        self.bot.loop.create_task(self.make_webserver())
+        self._starter = self.bot.loop.create_task(self.make_webserver())
 
     async def get_owner(self):
-        return await self.bot.get_user_info(self.bot.settings.owner)
+        # The owner hardly ever changes, don't ask Discord for it on every page view
+        if self._owner is None or time.monotonic() - self._owner_fetched > self.OWNER_TTL:
+            self._owner = await self.bot.get_user_info(self.bot.settings.owner)
+            self._owner_fetched = time.monotonic()
+        return self._owner
+
+    async def get_ip(self):
+        if self.ip is None:
+            try:
+                http = self.bot.get_cog('HTTPClient')
+                if http is None:
+                    return '0.0.0.0'
+                self.ip = (await http.get('https://api.ipify.org')).strip()
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                return '0.0.0.0'
+        return self.ip
 
     async def get_bot(self):
         return self.bot.user
 
-    async def _get_servers_html(self, data):
+    def _sorted(self, data, sort):
+        # Sorting thousands of servers once per snapshot and sort order is enough
+        servers = self._sorted_servers.get(sort)
+        if servers is None:
+            if sort == 'name':
+                servers = sorted(data['servers'], key=lambda server: server['name'].lower())
+            else:
+                servers = sorted(data['servers'], key=lambda server: server['members'], reverse=True)
+            self._sorted_servers[sort] = servers
+        return servers
+
+    def _page_count(self, data):
+        return max(math.ceil(len(data['servers']) / self.SERVERS_PER_PAGE), 1)
+
+    async def _get_servers_html(self, data, page=1, sort='members'):
         template = """
         <div class="server">
           <div class="avatar">
@@ -41,37 +96,54 @@ class WebStatistics:
             {name} ({members})
           </div>
         </div>"""
-        tmp = ''
-        for server in data['servers']:
-            if server['icon_url']:
-                icon_url = server['icon_url']
-            else:
-                icon_url = 'data:image/gif;base64,R0lGODlhAQABAPcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACH5BAEAAP8ALAAAAAABAAEAAAgEAP8FBAA7'
-            tmp += template.format(icon_url=icon_url, name=server['name'], members=server['members'])
-        return tmp
+        start = (page - 1) * self.SERVERS_PER_PAGE
+        servers = self._sorted(data, sort)[start:start + self.SERVERS_PER_PAGE]
+        return ''.join(
+            template.format(
+                icon_url=server['icon_url'] or '/static/placeholder.gif',
+                name=html.escape(server['name']), members=server['members'])
+            for server in servers)
+
+    def _get_server_pages_html(self, data, page, sort):
+        link = '<a class="white" href="/?page={page}&amp;sort={sort}">{text}</a>'
+        pages = self._page_count(data)
+        parts = ['Page {} of {}'.format(page, pages)]
+        if page > 1:
+            parts.append(link.format(page=page - 1, sort=sort, text='Previous'))
+        if page < pages:
+            parts.append(link.format(page=page + 1, sort=sort, text='Next'))
+        parts.append('Sort by ' + ' '.join(
+            link.format(page=1, sort=other, text=other) for other in self.SERVER_SORTS if other != sort))
+        return ' &middot; '.join(parts)
 
     async def _get_cogs_html(self, data):
         template = """
         <div class="other-thing">
             {cog}
         </div>"""
-        tmp = ''
-        for cog in data['loaded_cogs']:
-            tmp += template.format(cog=cog)
-        return tmp
+        return ''.join(template.format(cog=html.escape(cog)) for cog in data['loaded_cogs'])
+
+    def _get_activity_html(self, entries):
+        template = """
+        <div class="other-thing">
+            {name} <span class="white">{messages_per_minute}/min</span>
+        </div>"""
+        if not entries:
+            return '<div class="other-thing">No messages in the last minute</div>'
+        return ''.join(
+            template.format(name=html.escape(entry['name']), messages_per_minute=entry['messages_per_minute'])
+            for entry in entries)
 
     async def _get_commands_html(self, data):
         template = """
         <div class="other-thing">
             {command}
         </div>"""
-        tmp = ''
-        for command in data:
-            tmp += template.format(command=command)
-        return tmp
+        return ''.join(template.format(command=html.escape(command)) for command in data)
 
-    async def generate_body(self):
-        data = self.bot.get_cog('Statistics').redapi_hook()
+    async def generate_body(self, data=None, page=1, sort='members'):
+        if data is None:
+            data = self.bot.get_cog('Statistics').redapi_hook()
         bot_avatar_icon_url = data['avatar']
         name = '{0.name}#{0.discriminator}'.format(await self.get_bot())
         owner = '{0.name}#{0.discriminator}'.format(await self.get_owner())
@@ -93,40 +165,254 @@ class WebStatistics:
         threads = data['threads']
         io_reads = data['io_reads']
         io_writes = data['io_writes']
-        date_now = 'Page generated on {}'.format(datetime.datetime.utcnow())
-        servers = await self._get_servers_html(data)
+        date_now = 'Page generated on {}'.format(data.get('timestamp') or datetime.datetime.utcnow())
+        servers = await self._get_servers_html(data, page, sort)
+        server_pages = self._get_server_pages_html(data, page, sort)
         loaded_cogs = await self._get_cogs_html(data)
+        top_servers = self._get_activity_html(data['top_servers'])
+        top_channels = self._get_activity_html(data['top_channels'])
         body = web_template.format(
-                servers=servers, bot_avatar_icon_url=bot_avatar_icon_url, name=name,
+                servers=servers, server_pages=server_pages, bot_avatar_icon_url=bot_avatar_icon_url, name=name,
                 owner=owner, uptime=uptime, total_servers=total_servers, user_count=user_count,
                 active_cogs=active_cogs, total_commands=total_commands, total_channels=total_channels,
                 text_channels=text_channels, voice_channels=voice_channels, messages_received=messages_received,
                 commands_run=commands_run, cpu_usage=cpu_usage, memory_usage=memory_usage,
                 memory_usage_mb=memory_usage_mb, created=created, date_now=date_now, loaded_cogs=loaded_cogs,
-                all_commands=all_commands, threads=threads, io_reads=io_reads, io_writes=io_writes)
+                all_commands=all_commands, threads=threads, io_reads=io_reads, io_writes=io_writes,
+                top_servers=top_servers, top_channels=top_channels)
         return body
 
+    async def get_page(self, kind='html', *args):
+        """
+        Rendered page for the current statistics snapshot, rendered at most once per snapshot
+        """
+        snapshot = self.bot.get_cog('Statistics').get_snapshot()
+        if self._pages_timestamp != snapshot['timestamp']:
+            # Drop everything rendered from the previous snapshot
+            self._pages = {}
+            self._sorted_servers = {}
+            self._pages_timestamp = snapshot['timestamp']
+        key = (kind,) + args
+        page = self._pages.get(key)
+        if page is None:
+            async with self._page_lock:
+                # Another request may have rendered it while we waited
+                page = self._pages.get(key)
+                if page is None:
+                    page = await self._render_page(kind, snapshot, *args)
+                    if self._pages_timestamp == snapshot['timestamp']:
+                        self._pages[key] = page
+        return page
+
+    async def _render_page(self, kind, snapshot, *args):
+        if kind == 'json':
+            body = json.dumps(dict(snapshot), default=self._json_default).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        elif kind == 'metrics':
+            body = self.generate_metrics(snapshot).encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = (await self.generate_body(snapshot, *args)).encode('utf-8')
+            content_type = 'text/html; charset=utf-8'
+        modified_since = calendar.timegm(snapshot['timestamp'].utctimetuple())
+        return RenderedPage(
+            timestamp=snapshot['timestamp'], body=body, gzipped=gzip.compress(body), content_type=content_type,
+            etag='"{}"'.format(hashlib.sha1(body).hexdigest()),
+            last_modified=formatdate(modified_since, usegmt=True), modified_since=modified_since)
+
+    @staticmethod
+    def _json_default(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        return str(value)
+
+    def generate_metrics(self, data):
+        """
+        Statistics in the Prometheus text exposition format
+        """
+        metrics = [
+            ('messages_read_total', 'counter', 'Messages read since the bot started.', [('', data['read_messages'])]),
+            ('commands_run_total', 'counter', 'Commands processed since the bot started.', [('', data['commands_run'])]),
+            ('io_reads_total', 'counter', 'Read operations done by the bot process.', [('', data['io_reads'])]),
+            ('io_writes_total', 'counter', 'Write operations done by the bot process.', [('', data['io_writes'])]),
+            ('cpu_usage_percent', 'gauge', 'CPU usage of the bot process.', [('', data['cpu_usage'])]),
+            ('memory_uss_bytes', 'gauge', 'Unique set size of the bot process.', [('', data['mem_v_mb'])]),
+            ('memory_percent', 'gauge', 'Memory usage of the bot process.', [('', data['mem_v'])]),
+            ('threads', 'gauge', 'Threads in the bot process.', [('', data['threads'])]),
+            ('servers', 'gauge', 'Servers the bot is in.', [('', data['total_servers'])]),
+            ('users', 'gauge', 'Unique users the bot can see.', [('', data['users'])]),
+            ('channels', 'gauge', 'Channels the bot can see.', [
+                ('{type="text"}', data['text_channels']), ('{type="voice"}', data['voice_channels'])])]
+        lines = []
+        for name, kind, description, samples in metrics:
+            lines.append('# HELP redbot_{} {}'.format(name, description))
+            lines.append('# TYPE redbot_{} {}'.format(name, kind))
+            lines.extend('redbot_{}{} {}'.format(name, labels, value) for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+    def _not_modified(self, request, page):
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return page.etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = parsedate_tz(request.headers.get('If-Modified-Since', ''))
+        if if_modified_since is not None:
+            return mktime_tz(if_modified_since) >= page.modified_since
+        return False
+
+    def _live_fields(self, data):
+        # Keyed by element id on the page, already formatted for display
+        return {
+            'uptime': data['uptime'], 'total_servers': str(data['total_servers']), 'user_count': str(data['users']),
+            'total_channels': str(data['channels']), 'text_channels': str(data['text_channels']),
+            'voice_channels': str(data['voice_channels']), 'messages_received': str(data['read_messages']),
+            'commands_run': str(data['commands_run']), 'cpu_usage': '{:.1f}%'.format(data['cpu_usage']),
+            'memory': '{:.0f}MB ({:.1f}%)'.format(int(data['mem_v_mb']) / 1024 / 1024, data['mem_v']),
+            'threads': str(data['threads']), 'io_reads': str(data['io_reads']), 'io_writes': str(data['io_writes'])}
+
+    @staticmethod
+    def _live_event(fields):
+        return 'event: stats\ndata: {}\n\n'.format(json.dumps(fields)).encode('utf-8')
+
+    def _live_push(self, queue, payload):
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # The client fell behind, replace its backlog with the full current state
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(self._live_full if payload is not None else None)
+
+    async def on_statistics_snapshot(self, snapshot):
+        fields = self._live_fields(snapshot)
+        changed = {key: value for key, value in fields.items() if self._live_state.get(key) != value}
+        self._live_state = fields
+        self._live_full = self._live_event(fields)
+        if not changed:
+            return
+        # Serialized once, the same bytes go to every client
+        payload = self._live_event(changed)
+        for queue in self._live_clients:
+            self._live_push(queue, payload)
+
+    async def _serve(self, request, kind, *args):
+        rendered = await self.get_page(kind, *args)
+        headers = {
+            'ETag': rendered.etag, 'Last-Modified': rendered.last_modified,
+            'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if self._not_modified(request, rendered):
+            return web.Response(status=304, headers=headers)
+        headers['Content-Type'] = rendered.content_type
+        body = rendered.body
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            body = rendered.gzipped
+        if len(body) < self.STREAM_THRESHOLD:
+            return web.Response(body=body, headers=headers)
+        # Stream big pages in chunks instead of handing one huge buffer to the transport
+        response = web.StreamResponse(headers=headers)
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        view = memoryview(body)
+        for start in range(0, len(body), self.CHUNK_SIZE):
+            response.write(view[start:start + self.CHUNK_SIZE])
+            await response.drain()
+        await response.write_eof()
+        return response
+
     async def make_webserver(self):
         async def page(request):
-            body = await self.generate_body()
-            return web.Response(text=body, content_type='text/html')
+            data = self.bot.get_cog('Statistics').get_snapshot()
+            sort = request.GET.get('sort', 'members')
+            if sort not in self.SERVER_SORTS:
+                sort = 'members'
+            try:
+                number = int(request.GET.get('page', 1))
+            except ValueError:
+                number = 1
+            number = min(max(number, 1), self._page_count(data))
+            return await self._serve(request, 'html', number, sort)
+
+        async def live(request):
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+            await response.prepare(request)
+            if self._live_full is None:
+                self._live_state = self._live_fields(self.bot.get_cog('Statistics').get_snapshot())
+                self._live_full = self._live_event(self._live_state)
+            queue = asyncio.Queue(maxsize=self.LIVE_QUEUE_SIZE)
+            queue.put_nowait(self._live_full)
+            self._live_clients.add(queue)
+            try:
+                while True:
+                    payload = await queue.get()
+                    if payload is None:
+                        break
+                    response.write(payload)
+                    await response.drain()
+            finally:
+                self._live_clients.discard(queue)
+            return response
+
+        async def placeholder(request):
+            headers = {'Content-Type': 'image/gif', 'Cache-Control': 'public, max-age=86400'}
+            return web.Response(body=PLACEHOLDER_ICON, headers=headers)
+
+        async def api_stats(request):
+            return await self._serve(request, 'json')
 
-        await asyncio.sleep(10)
+        async def metrics(request):
+            return await self._serve(request, 'metrics')
+
+        async def healthz(request):
+            statistics = self.bot.get_cog('Statistics')
+            ready = self.bot.is_logged_in and not self.bot.is_closed and statistics is not None
+            body = {'status': 'ok' if ready else 'unavailable', 'live_clients': len(self._live_clients)}
+            return web.json_response(body, status=200 if ready else 503, headers={'Cache-Control': 'no-cache'})
 
         self.app.router.add_get('/', page)
+        self.app.router.add_get('/api/stats', api_stats)
+        self.app.router.add_get('/metrics', metrics)
+        self.app.router.add_get('/live', live)
+        self.app.router.add_get('/static/placeholder.gif', placeholder)
+        self.app.router.add_get('/healthz', healthz)
         self.handler = self.app.make_handler()
 
+        # Pages need the bot's user and servers, start serving as soon as they are there
+        await self.bot.wait_until_ready()
         self.server = await self.bot.loop.create_server(self.handler, '0.0.0.0', self.port)
 
-        print('webstatistics.py: Serving on http://{}:{}'.format(self.ip, self.port))
-        message = 'Serving Web Statistics on http://{}:{}'.format(self.ip, self.port)
+        # The public address is only needed for the message below, so it is looked up after the server is up
+        ip = await self.get_ip()
+        print('webstatistics.py: Serving on http://{}:{}'.format(ip, self.port))
+        message = 'Serving Web Statistics on http://{}:{}'.format(ip, self.port)
 
         await self.bot.send_message(await self.get_owner(), message)
 
+    async def _shutdown(self):
+        await self.app.shutdown()
+        if self.handler is not None:
+            # Connections still open after the timeout are dropped
+            await self.handler.shutdown(self.SHUTDOWN_TIMEOUT)
+        if self.server is not None:
+            await self.server.wait_closed()
+        await self.app.cleanup()
+
+    async def _stop(self):
+        try:
+            await asyncio.wait_for(self._shutdown(), self.SHUTDOWN_TIMEOUT * 2)
+        except asyncio.TimeoutError:
+            print('webstatistics.py: Server did not stop in time, giving up on it')
+        else:
+            print('webstatistics.py: Server stopped')
+
     def __unload(self):
-        self.server.close()
-        self.server.wait_closed()
+        self._starter.cancel()
+        for queue in self._live_clients:
+            self._live_push(queue, None)
+        if self.server is not None:
+            # Stop listening right away so a reloaded cog can bind the port again
+            self.server.close()
         print('webstatistics.py: Stopping server')
+        self.bot.loop.create_task(self._stop())
 
 
 def check_folder():
@@ -144,9 +430,7 @@ def check_file():
 
 
 def setup(bot):
-    if not has_ipgetter:
-        raise RuntimeError('ipgetter is not installed. Run `pip3 install ipgetter --upgrade` to use this cog.')
-    elif not bot.get_cog('Statistics'):
+    if not bot.get_cog('Statistics'):
         raise RuntimeError('To run this cog, you need the Statistics cog')
     else:
         check_folder()